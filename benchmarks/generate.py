@@ -0,0 +1,234 @@
+import argparse
+import os
+import random
+
+import numpy as np
+from sc_compression.compression import Compressor
+
+from utils.chunks import ScWriter
+from utils.pixels import PIXEL_SIZES
+
+
+TILED_FILE_TYPES = [27, 28]
+
+
+def write_chunk(writer: ScWriter, tag: int, payload: ScWriter):
+    writer.writeUByte(tag)
+    writer.writeUInt32(len(payload.buffer))
+    writer.write(payload.buffer)
+
+
+def tile_pixels(pixels: np.ndarray, tile_size: int = 32) -> np.ndarray:
+    """Lays a (height, width, size) array out tile by tile, the inverse of join_pixels."""
+    height, width = pixels.shape[:2]
+
+    tiles = []
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            tiles.append(pixels[y:y + tile_size, x:x + tile_size].reshape(-1, pixels.shape[2]))
+    return np.concatenate(tiles)
+
+
+def texture_pixels(pixel_type: int, width: int, height: int, seed: int = 0) -> np.ndarray:
+    """Returns a deterministic (height, width, pixel size) pattern of raw pixel bytes."""
+    pixel_size = PIXEL_SIZES[pixel_type]
+
+    y, x = np.mgrid[:height, :width].astype(np.uint32)
+    pattern = (x * 7 + y * 3 + seed * 31)[..., None] + np.arange(pixel_size, dtype=np.uint32) * 61
+    return (pattern & 0xFF).astype(np.uint8)
+
+
+def texture_specs(count: int, width: int, height: int) -> list:
+    """Returns (file_type, pixel_type, width, height) for count textures, cycling through every pixel type.
+
+    Every second texture uses one of the tiled file types.
+    """
+    pixel_types = sorted(PIXEL_SIZES)
+
+    specs = []
+    for i in range(count):
+        file_type = TILED_FILE_TYPES[i // 2 % len(TILED_FILE_TYPES)] if i % 2 else 1
+        specs.append((file_type, pixel_types[i % len(pixel_types)], width, height))
+    return specs
+
+
+def generate_texture_file(path: str, textures: list):
+    writer = ScWriter()
+    for i, (file_type, pixel_type, width, height) in enumerate(textures):
+        pixels = texture_pixels(pixel_type, width, height, i)
+        if file_type in TILED_FILE_TYPES:
+            pixels = tile_pixels(pixels)
+
+        writer.writeUByte(file_type)
+        writer.writeUInt32(pixels.size + 5)
+        writer.writeUByte(pixel_type)
+        writer.writeUShort(width)
+        writer.writeUShort(height)
+        writer.write(pixels.tobytes())
+    writer.writeUByte(0)
+    writer.writeUInt32(0)
+
+    with open(path, 'wb') as fh:
+        fh.write(Compressor().compress(bytes(writer.buffer), 'sc'))
+
+
+def generate_sc_file(path: str, textures: list, shapes: int = 256, regions: int = 4, clips: int = 64,
+                     binds: int = 8, exports: int = 16, text_fields: int = 8, seed: int = 0) -> dict:
+    """Writes an .sc file whose shapes cut random quads out of the given textures.
+
+    Clips bind shapes, text fields and earlier clips, so the hierarchy is
+    nested but acyclic. The first exports clips are exported. Returns the
+    number of chunks of every kind.
+    """
+    generator = random.Random(seed)
+    exports = min(exports, clips)
+
+    shape_ids = list(range(shapes))
+    text_field_ids = list(range(shapes, shapes + text_fields))
+    clip_ids = list(range(shapes + text_fields, shapes + text_fields + clips))
+
+    writer = ScWriter()
+    for count in [shapes, clips, len(textures), text_fields, clips, 1]:
+        writer.writeUShort(count)
+    writer.writeInt32(0)
+    writer.writeByte(0)
+
+    writer.writeUShort(exports)
+    for clip_id in clip_ids[-exports:]:
+        writer.writeUShort(clip_id)
+    for i in range(exports):
+        writer.writeString(f'export_{i}')
+
+    for _, pixel_type, width, height in textures:
+        payload = ScWriter()
+        payload.writeByte(pixel_type)
+        payload.writeUShort(width)
+        payload.writeUShort(height)
+        write_chunk(writer, 1, payload)
+
+    for i in range(clips):
+        payload = ScWriter()
+        for value in [1024, 0, 0, 1024, i * 20, -i * 20]:
+            payload.writeInt32(value)
+        write_chunk(writer, 8, payload)
+
+    payload = ScWriter()
+    payload.write(bytes([255, 255, 255, 255, 0, 0, 0]))
+    write_chunk(writer, 9, payload)
+
+    for shape_id in shape_ids:
+        payload = ScWriter()
+        payload.writeUShort(shape_id)
+        payload.writeUShort(regions)
+        payload.writeUShort(regions * 4)
+
+        for _ in range(regions):
+            texture_id = generator.randrange(len(textures))
+            _, _, width, height = textures[texture_id]
+
+            region_width = generator.randint(1, min(width, 128))
+            region_height = generator.randint(1, min(height, 128))
+            left = generator.randint(0, width - region_width)
+            top = generator.randint(0, height - region_height)
+            corners = [
+                (left, top), (left + region_width, top),
+                (left + region_width, top + region_height), (left, top + region_height)
+            ]
+
+            region = ScWriter()
+            region.writeByte(texture_id)
+            region.writeUByte(len(corners))
+            for x, y in corners:
+                region.writeInt32((x - left) * 20)
+                region.writeInt32((y - top) * 20)
+            for x, y in corners:
+                region.writeUShort(x * 65535 // width)
+                region.writeUShort(y * 65535 // height)
+            write_chunk(payload, 22, region)
+        write_chunk(payload, 0, ScWriter())
+        write_chunk(writer, 2, payload)
+
+    for text_field_id in text_field_ids:
+        payload = ScWriter()
+        payload.writeUShort(text_field_id)
+        payload.writeString('font')
+        write_chunk(writer, 7, payload)
+
+    for i, clip_id in enumerate(clip_ids):
+        children = shape_ids + text_field_ids + clip_ids[:i]
+        bind_ids = [generator.choice(children) for _ in range(binds)]
+
+        payload = ScWriter()
+        payload.writeUShort(clip_id)
+        payload.writeByte(24)
+        payload.writeUShort(2)
+
+        payload.writeUInt32(binds)
+        for bind_index in range(binds):
+            payload.writeUShort(bind_index)
+            payload.writeUShort(i)
+            payload.writeUShort(0xFFFF)
+
+        payload.writeShort(binds)
+        for bind_id in bind_ids:
+            payload.writeUShort(bind_id)
+        for bind_id in bind_ids:
+            payload.writeString(f'bind_{bind_id}')
+
+        for frame_transforms, frame_name in [(binds // 2, 'start'), (binds - binds // 2, None)]:
+            frame = ScWriter()
+            frame.writeShort(frame_transforms)
+            frame.writeString(frame_name)
+            write_chunk(payload, 11, frame)
+        write_chunk(payload, 0, ScWriter())
+        write_chunk(writer, 3, payload)
+
+    write_chunk(writer, 0, ScWriter())
+
+    with open(path, 'wb') as fh:
+        fh.write(Compressor().compress(bytes(writer.buffer), 'sc'))
+
+    return {
+        'textures': len(textures), 'matrix': clips, 'color_transformations': 1, 'shapes': shapes,
+        'regions': shapes * regions, 'text_fields': text_fields, 'clips': clips, 'exports': exports
+    }
+
+
+def generate(directory: str, basename: str = 'bench', width: int = 1024, height: int = 1024, textures: int = 10,
+             **kwargs) -> dict:
+    """Writes <basename>_tex.sc and <basename>.sc to directory and returns what they contain."""
+    os.makedirs(directory, exist_ok=True)
+
+    specs = texture_specs(textures, width, height)
+    generate_texture_file(os.path.join(directory, basename + '_tex.sc'), specs)
+    counts = generate_sc_file(os.path.join(directory, basename + '.sc'), specs, **kwargs)
+    counts['pixels'] = sum(width * height for _, _, width, height in specs)
+
+    return counts
+
+
+def main(arguments: list = None):
+    parser = argparse.ArgumentParser(description='Writes deterministic synthetic .sc and _tex.sc files.')
+    parser.add_argument('directory', nargs='?', default='sc', help='output folder (default: sc)')
+    parser.add_argument('--basename', default='bench', help='file name without extension (default: bench)')
+    parser.add_argument('--width', type=int, default=1024, help='atlas width (default: 1024)')
+    parser.add_argument('--height', type=int, default=1024, help='atlas height (default: 1024)')
+    parser.add_argument('--textures', type=int, default=10,
+                        help='number of atlases, cycling through every pixel type and tiling (default: 10)')
+    parser.add_argument('--shapes', type=int, default=256, help='number of shapes (default: 256)')
+    parser.add_argument('--regions', type=int, default=4, help='regions per shape (default: 4)')
+    parser.add_argument('--clips', type=int, default=64, help='number of clips (default: 64)')
+    parser.add_argument('--binds', type=int, default=8, help='binds per clip (default: 8)')
+    parser.add_argument('--exports', type=int, default=16, help='number of exported clips (default: 16)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    args = parser.parse_args(arguments)
+
+    counts = generate(
+        args.directory, args.basename, args.width, args.height, args.textures, shapes=args.shapes,
+        regions=args.regions, clips=args.clips, binds=args.binds, exports=args.exports, seed=args.seed
+    )
+    print(', '.join(f'{name}: {count}' for name, count in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+from sc_compression.compression import Decompressor
+
+from benchmarks.generate import generate
+from main import SC
+from utils.cache import ParseCache
+
+
+def decompress(path: str) -> bytes:
+    with open(path, 'rb') as fh:
+        return Decompressor().decompress(fh.read())
+
+
+def first_difference(a: bytes, b: bytes) -> int:
+    """Returns the offset of the first byte that differs, or None if a and b are the same."""
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return i
+    return None if len(a) == len(b) else min(len(a), len(b))
+
+
+def roundtrip(directory: str, basename: str) -> list:
+    """Parses <basename>.sc in directory, freshly and from a parse cache, saves it and compares the payloads.
+
+    Returns (source, offset of the first difference or None) rows.
+    """
+    original = decompress(os.path.join(directory, basename + '.sc'))
+    cache = ParseCache(os.path.join(directory, 'cache'))
+
+    results = []
+    for source in ['parse', 'cache']:
+        with contextlib.redirect_stdout(io.StringIO()):
+            sc = SC(basename + '.sc', directory=directory, cache=cache)
+            sc.parse()
+
+        path = os.path.join(directory, f'{basename}_{source}.sc')
+        sc.save(path)
+        results.append((source, first_difference(original, decompress(path))))
+    return results
+
+
+def main(arguments: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Checks that synthetic .sc files are saved back unchanged.')
+    parser.add_argument('--seeds', type=int, default=3, help='number of generated files to check (default: 3)')
+    args = parser.parse_args(arguments)
+
+    failed = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for seed in range(args.seeds):
+            generate(directory, f'bench_{seed}', 64, 64, 5, shapes=32, clips=16, exports=4, seed=seed)
+            for source, offset in roundtrip(directory, f'bench_{seed}'):
+                if offset is None:
+                    print(f'[OK] seed {seed}, {source}')
+                else:
+                    failed += 1
+                    print(f'[FAILED] seed {seed}, {source}: payloads differ from byte {offset}')
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
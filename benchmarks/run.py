@@ -0,0 +1,174 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+from sc_compression.compression import Decompressor
+
+from benchmarks.generate import generate
+from main import SC, Unpacker
+from utils.cache import ParseCache
+from utils.compositor import Compositor
+from utils.graph import pack_graph
+from utils.pixels import PIXEL_SIZES, decode_pixels, join_pixels, get_pixel_size
+from utils.render import RegionCache
+
+
+def best_time(function, repeat: int) -> float:
+    """Returns the fastest of repeat runs of function, in seconds."""
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(directory: str, basename: str, counts: dict, repeat: int = 3) -> list:
+    """Times every pipeline stage on <basename>_tex.sc and <basename>.sc in directory.
+
+    Returns (stage, seconds, amount, unit) rows. Stages that write files
+    write them relative to the working directory.
+    """
+    results = []
+
+    texture_path = os.path.join(directory, basename + '_tex.sc')
+    with open(texture_path, 'rb') as fh:
+        compressed = fh.read()
+    decompressed = Decompressor().decompress(compressed)
+    results.append(('decompress', best_time(lambda: Decompressor().decompress(compressed), repeat),
+                    len(decompressed), 'bytes'))
+
+    textures = SC(basename + '_tex.sc', directory=directory)
+    with contextlib.redirect_stdout(io.StringIO()):
+        textures.parse(False)
+
+    def parse_textures():
+        SC(basename + '_tex.sc', directory=directory).parse(False)
+    results.append(('textures', best_time(parse_textures, repeat), counts['pixels'], 'pixels'))
+
+    width, height = textures.images[0].size
+    for pixel_type in sorted(PIXEL_SIZES):
+        buffer = bytes(width * height * get_pixel_size(pixel_type))
+        results.append((f'decode_pixels[{pixel_type}]',
+                        best_time(lambda: decode_pixels(buffer, pixel_type, width, height), repeat),
+                        width * height, 'pixels'))
+
+    pixels = decode_pixels(bytes(width * height * 4), 0, width, height)
+    results.append(('join_pixels', best_time(lambda: join_pixels(pixels, width, height), repeat),
+                    width * height, 'pixels'))
+
+    def parse():
+        sc = SC(basename + '.sc', directory=directory)
+        sc.parse()
+        return sc
+    with contextlib.redirect_stdout(io.StringIO()):
+        sc = parse()
+    results.append(('parse', best_time(parse, repeat), len(sc.index), 'chunks'))
+
+    def parse_lazy():
+        SC(basename + '.sc', directory=directory).parse(lazy=True)
+    results.append(('parse_lazy', best_time(parse_lazy, repeat), len(sc.index), 'chunks'))
+
+    with tempfile.TemporaryDirectory() as cache_directory:
+        cache = ParseCache(cache_directory)
+
+        def cache_store():
+            cache.store(cache.key(sc.path), pack_graph(sc))
+        results.append(('cache_store', best_time(cache_store, repeat),
+                        sum(entry.stat().st_size for entry in os.scandir(cache_directory)), 'bytes'))
+
+        def cache_hit():
+            cached = SC(basename + '.sc', directory=directory, cache=cache)
+            cached.parse()
+            assert cached.cached
+        results.append(('cache_hit', best_time(cache_hit, repeat), len(sc.index), 'chunks'))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        unpacker = Unpacker(sc, textures.images, [])
+    regions = [region for shape in sc.shapes.values() for region in shape.regions]
+
+    def draw_regions():
+        unpacker.region_cache = RegionCache(0)
+        for region in regions:
+            unpacker.draw_region(region)
+    results.append(('draw_region', best_time(draw_regions, repeat), len(regions), 'regions'))
+
+    compositor = Compositor(sc, textures.images)
+
+    def composite():
+        for export in sc.exports:
+            compositor.render_frame(sc.clips[export.id])
+    results.append(('composite', best_time(composite, repeat), len(sc.exports), 'frames'))
+
+    def export():
+        return Unpacker(parse(), textures.images)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sprite_writer = export().sprite_writer
+    results.append(('export', best_time(export, repeat), sprite_writer.written + sprite_writer.linked, 'sprites'))
+
+    return results
+
+
+def main(arguments: list = None):
+    parser = argparse.ArgumentParser(description='Times the unpacking stages on synthetic .sc files.')
+    parser.add_argument('--width', type=int, default=1024, help='atlas width (default: 1024)')
+    parser.add_argument('--height', type=int, default=1024, help='atlas height (default: 1024)')
+    parser.add_argument('--textures', type=int, default=10, help='number of atlases (default: 10)')
+    parser.add_argument('--shapes', type=int, default=256, help='number of shapes (default: 256)')
+    parser.add_argument('--regions', type=int, default=4, help='regions per shape (default: 4)')
+    parser.add_argument('--clips', type=int, default=64, help='number of clips (default: 64)')
+    parser.add_argument('--binds', type=int, default=8, help='binds per clip (default: 8)')
+    parser.add_argument('--exports', type=int, default=16, help='number of exported clips (default: 16)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs per stage, the fastest counts (default: 3)')
+    parser.add_argument('--json', metavar='PATH', help='also write the results to this file')
+    args = parser.parse_args(arguments)
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            counts = generate(
+                'sc', 'bench', args.width, args.height, args.textures, shapes=args.shapes, regions=args.regions,
+                clips=args.clips, binds=args.binds, exports=args.exports, seed=args.seed
+            )
+            results = benchmark('sc', 'bench', counts, args.repeat)
+        finally:
+            os.chdir(working_directory)
+
+    print(f'{"stage":<20}{"seconds":>12}{"amount":>12}  throughput')
+    for stage, seconds, amount, unit in results:
+        print(f'{stage:<20}{seconds:>12.4f}{amount:>12}  {amount / seconds:,.0f} {unit}/s')
+
+    if json_path is not None:
+        with open(json_path, 'w') as fh:
+            json.dump({
+                'revision': git_revision(),
+                'options': vars(args),
+                'counts': counts,
+                'results': [
+                    {'stage': stage, 'seconds': seconds, 'amount': amount, 'unit': unit}
+                    for stage, seconds, amount, unit in results
+                ]
+            }, fh, indent=4)
+
+
+if __name__ == '__main__':
+    main()
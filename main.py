@@ -1,111 +1,86 @@
+import argparse
+import asyncio
+import json
 import os
 import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
 from PIL import Image, ImageDraw
-from sc_compression.compression import Decompressor
+from sc_compression.compression import Compressor, Decompressor
 
 from utils.chunks import Export, Texture, Shape, MovieClip, TextField, Matrix, Color, ScObject
-from utils.chunks import CustomObject
+from utils.cache import ParseCache, PayloadCache
+from utils.compositor import Compositor
+from utils.graph import COUNT_ATTRIBUTES, Graph, pack_graph
+from utils.chunks import CustomObject, ScWriter, ChunkEntry, LazyChunks
+from utils.pixels import decode_pixels, join_pixels, get_pixel_format, get_pixel_size
 from utils.reader import Reader
+from utils.metrics import Metrics, Progress
+from utils.output import ANIMATION_FORMATS, IMAGE_FORMATS, SpriteSheet, save_animation, save_image
+from utils.pipeline import Stage, run_pipeline
+from utils.render import ColorTransforms, RegionCache, SpriteWriter, apply_color
+from utils.stream import open_stream
+
+
+progress = Progress()
 
 
 def progressbar(current, total, message):
-    sys.stdout.write(f"\r[{percent(current, total)}%] {message}")
+    if progress.due(current, total):
+        sys.stdout.write(f"\r[{percent(current, total)}%] {message}")
 
 
 def percent(current, total):
     return (current + 1) * 100 // total
 
 
-def join_image(img, p):
-    _w, _h = img.size
-    imgl = img.load()
-    x = 0
-    a = 32
-
-    _ha = _h // a
-    _wa = _w // a
-    ha = _h % a
-    wa = _w % a
-
-    for l in range(_ha):
-        for k in range(_wa):
-            for j in range(a):
-                for h in range(a):
-                    imgl[h + k * a, j + l * a] = p[x]
-                    x += 1
-
-        for j in range(a):
-            for h in range(wa):
-                imgl[h + (_w - wa), j + l * a] = p[x]
-                x += 1
-        progressbar(l, _ha, 'Joining picture...')
-
-    for k in range(_wa):
-        for j in range(ha):
-            for h in range(a):
-                imgl[h + k * a, j + (_h - ha)] = p[x]
-                x += 1
-
-    for j in range(ha):
-        for h in range(wa):
-            imgl[h + (_w - wa), j + (_h - ha)] = p[x]
-            x += 1
-    progressbar(l, _ha, 'Joining picture...')
-    print()
+TEXTURE_TAGS = [1, 16, 28, 29, 34]
+SHAPE_TAGS = [2, 18]
+MOVIE_CLIP_TAGS = [3, 10, 12, 14]
+TEXT_FIELD_TAGS = [7, 15, 20, 21, 25, 33]
+END_TAG = 0
 
+TagType = namedtuple('TagType', ['chunk_type', 'collection', 'has_id'])
 
-class SC(ScObject):
-    def readPixel(self, pixel_type) -> tuple:
-        if pixel_type == 0:
-            r = self.readUByte()
-            g = self.readUByte()
-            b = self.readUByte()
-            a = self.readUByte()
-            return r, g, b, a
-        elif pixel_type == 2:
-            pixel = self.readUShort()
-            r = ((pixel >> 12) & 0xF) << 4
-            g = ((pixel >> 8) & 0xF) << 4
-            b = ((pixel >> 4) & 0xF) << 4
-            a = ((pixel >> 0) & 0xF) << 4
-            return r, g, b, a
-        elif pixel_type == 4:
-            pixel = self.readUShort()
-            r = ((pixel >> 11) & 0x1F) << 3
-            g = ((pixel >> 5) & 0x3F) << 2
-            b = (pixel & 0x1F) << 3
-            return r, g, b
-        elif pixel_type == 6:
-            pixel = self.readUShort()
-            r = (pixel >> 8)
-            g = (pixel >> 8)
-            b = (pixel >> 8)
-            a = (pixel & 0xFF)
-            return r, g, b, a
-        elif pixel_type == 10:
-            pixel = self.readUByte()
-            r = pixel
-            g = pixel
-            b = pixel
-            return r, g, b
-
-    def __init__(self, filename: str):
-        self.basename = os.path.splitext(filename)[0]
+TAGS = {}
 
-        with open(f'sc/{filename}', 'rb') as fh:
-            buffer = fh.read()
-            fh.close()
 
-        decompressor = Decompressor()
-        buffer = decompressor.decompress(buffer)
+def register_tags(tags: list, chunk_type: type, collection: str, has_id: bool = False):
+    """Parses chunks of the given tags with chunk_type and adds them to the SC attribute named collection.
 
-        Reader.__init__(self, buffer, 'little')
+    Chunks with has_id start with their id and can be parsed lazily.
+    """
+    for tag in tags:
+        TAGS[tag] = TagType(chunk_type, collection, has_id)
 
+
+register_tags(TEXTURE_TAGS, Texture, 'textures')
+register_tags(SHAPE_TAGS, Shape, 'shapes', True)
+register_tags(MOVIE_CLIP_TAGS, MovieClip, 'clips', True)
+register_tags(TEXT_FIELD_TAGS, TextField, 'text_fields', True)
+register_tags([8], Matrix, 'matrix')
+register_tags([9], Color, 'color_transformations')
+
+
+class SC(ScObject):
+    def __init__(self, filename: str, stream: bool = False, directory: str = 'sc', cache: ParseCache = None,
+                 metrics: Metrics = None, payload_cache: PayloadCache = None, compressed: bytes = None,
+                 output_folder: str = ''):
+        self.basename = os.path.splitext(filename)[0]
         self.is_texture = self.basename.endswith('_tex')
-        if self.is_texture:
-            if not os.path.exists('png'):
-                os.mkdir('png')
+        self.path = os.path.join(directory, filename)
+        # Outputs go to <output_name>/ under png/ and sprites/
+        self.output_name = os.path.join(output_folder, self.basename)
+        self.metrics = metrics if metrics is not None else Metrics(self.path)
+        self.payload_cache = payload_cache
+
+        self.stream = None
+        self.stream_size: int = 0
+
+        Reader.__init__(self, b'', 'little')
 
         self.shape_count: int = 0
         self.clips_count: int = 0
@@ -122,51 +97,157 @@ class SC(ScObject):
         self.color_transformations: list = []
 
         self.exports: list = []
+        self.chunks: list = []
+        self.images: list = []
+
+        self.index: list = []
+        self.lazy: bool = False
+
+        self.unknown_integer: int = 0
+        self.unknown_byte: int = 0
+
+        self.cache = None
+        self.cache_key = None
+        self.cached: bool = False
+        self.graph: Graph = None
+
+        if cache is not None and not self.is_texture:
+            self.cache = cache
+            self.cache_key = cache.key(self.path)
+
+            with self.metrics.phase('cache_load') as phase:
+                arrays = cache.load(self.cache_key)
+                if arrays is not None:
+                    self.load_graph(Graph(arrays))
+                    phase.add(sum(array.nbytes for array in arrays.values()))
+
+        if not self.cached:
+            self.load(stream, compressed)
+
+    def load(self, stream: bool = False, compressed: bytes = None):
+        """Decompresses the file; compressed may hold its contents, already read.
+
+        With a payload cache, a file decompressed before is memory-mapped from
+        it instead, and a file that is not cached yet is decompressed whole and
+        stored, even when streaming.
+        """
+        payload_key = None
+        if self.payload_cache is not None:
+            with self.metrics.phase('payload_load') as phase:
+                payload_key = self.payload_cache.key(self.path)
+                buffer = self.payload_cache.load(payload_key)
+                phase.add(len(buffer) if buffer is not None else 0, int(buffer is not None))
+
+            if buffer is not None:
+                Reader.__init__(self, buffer, 'little')
+                return
+            stream = False
+
+        with self.metrics.phase('decompress') as phase:
+            if stream:
+                source, size = open_stream(self.path)
+                if self.is_texture:
+                    buffer = b''
+                    self.stream, self.stream_size = source, size
+                else:
+                    buffer = source.read(size)
+            else:
+                if compressed is None:
+                    with open(self.path, 'rb') as fh:
+                        compressed = fh.read()
+
+                decompressor = Decompressor()
+                buffer = decompressor.decompress(compressed)
+            phase.add(len(buffer))
+
+        if payload_key is not None:
+            with self.metrics.phase('payload_store') as phase:
+                self.payload_cache.store(payload_key, buffer)
+                phase.add(len(buffer))
+
+        Reader.__init__(self, buffer, 'little')
+
+    def load_graph(self, graph: Graph):
+        """Takes the chunks from a cached graph; shapes, clips and text fields are built when looked up."""
+        for name in COUNT_ATTRIBUTES:
+            setattr(self, name, graph.header[name])
+
+        self.exports = graph.exports
+        self.textures = graph.textures
+        self.matrix = graph.matrix
+        self.color_transformations = graph.color_transformations
+        self.shapes = graph.shapes
+        self.clips = graph.clips
+        self.text_fields = graph.text_fields
 
-    def parse(self):
+        self.graph = graph
+        self.lazy = True
+        self.cached = True
+
+    def read(self, length: int = 1):
+        if self.stream is None:
+            return super().read(length)
+
+        self.i += length
+        return self.stream.read(length)
+
+    def remaining(self) -> int:
+        if self.stream is None:
+            return super().remaining()
+        return self.stream_size - self.i
+
+    def parse(self, export_textures: bool = True, lazy: bool = False, image_format: str = 'png'):
         if self.is_texture:
-            export_folder = 'png/' + self.basename + '/'
+            export_folder = 'png/' + self.output_name + '/'
 
-            if not os.path.exists(export_folder):
-                os.mkdir(export_folder)
+            if export_textures:
+                os.makedirs(export_folder, exist_ok=True)
 
             i = 0
-            while len(self.buffer[self.tell():]) > 10:
-                file_type = self.readUByte()
-                file_size = self.readUInt32()
-                pixel_type = self.readUByte()
-                width = self.readUShort()
-                height = self.readUShort()
-
-                pixels = []
-                for y in range(height):
-                    for x in range(width):
-                        pixels.append(self.readPixel(pixel_type))
-                        progressbar(len(pixels), width * height, 'Creating picture...')
-
-                if pixel_type in range(4):
-                    img_format = 'RGBA'
-                elif pixel_type == 4:
-                    img_format = 'RGB'
-                elif pixel_type == 6:
-                    img_format = 'LA'
-                elif pixel_type == 10:
-                    img_format = 'L'
+            while self.remaining() > 10:
+                header = Reader(self.read(10), 'little')
+                file_type = header.readUByte()
+                file_size = header.readUInt32()
+                pixel_type = header.readUByte()
+                width = header.readUShort()
+                height = header.readUShort()
+
+                img_format = get_pixel_format(pixel_type)
+                pixel_size = get_pixel_size(pixel_type)
+
+                if self.stream is not None:  # Streamed textures are decompressed while they are read
+                    with self.metrics.phase('decompress') as phase:
+                        data = self.read(width * height * pixel_size)
+                        phase.add(len(data), 0)
                 else:
-                    raise TypeError('Ban.')
-
-                image = Image.new(img_format, (width, height))
+                    data = self.read(width * height * pixel_size)
 
-                image.putdata(pixels)
+                with self.metrics.phase('pixel_decode') as phase:
+                    pixels = decode_pixels(data, pixel_type, width, height)
+                    phase.add(len(data), width * height)
+                progressbar(height - 1, height, 'Creating picture...')
+                print()
 
                 if file_type in [27, 28]:
-                    join_image(image, pixels)
+                    with self.metrics.phase('detile') as phase:
+                        pixels = join_pixels(pixels, width, height)
+                        phase.add(pixels.nbytes, width * height)
+
+                image = Image.frombuffer(img_format, (width, height), pixels, 'raw', img_format, 0, 1)
 
-                export_path = export_folder + self.basename + '_' * i + '.png'
+                self.images.append(image)
 
-                image.save(export_path)
+                if export_textures:
+                    export_path = export_folder + self.basename + '_' * i
+
+                    with self.metrics.phase('png_encode') as phase:
+                        export_paths = save_image(image, export_path, image_format)
+                        phase.add(sum(os.path.getsize(path) for path in export_paths))
                 i += 1
-        else:
+
+            if self.stream is not None:
+                self.stream.close()
+        elif not self.cached:
             self.shape_count = self.readUShort()
             self.clips_count = self.readUShort()
             self.textures_count = self.readUShort()
@@ -174,8 +255,8 @@ class SC(ScObject):
             self.matrix_count = self.readUShort()
             self.color_transformations_count = self.readUShort()
 
-            self.readInt32()
-            self.readByte()
+            self.unknown_integer = self.readInt32()
+            self.unknown_byte = self.readByte()
 
             exports_count = self.readUShort()
             for x in range(exports_count):
@@ -185,58 +266,59 @@ class SC(ScObject):
             for x in range(exports_count):
                 self.exports[x].name = self.readString()
 
-            while len(self.buffer[self.tell():]) >= 5:
-                progressbar(len(self.buffer) - len(self.buffer[self.tell():]), len(self.buffer),
-                            'Data Parsing...')
-
-                tag = self.readUByte()
-                length = self.readUInt32()
-                data = self.read(length)
-
-                if tag in [1, 16, 28, 29, 34]:  # Texture
-                    texture = Texture(data, tag)
-                    texture.parse()
-
-                    self.textures.append(texture)
-                elif tag in [2, 18]:  # Shape Id
-                    shape = Shape(data, tag)
-                    shape.parse(textures=self.textures)
-
-                    self.shapes.append(shape)
-                elif tag in [3, 10, 12, 14]:  # MovieClip
-                    movie_clip = MovieClip(data, tag)
-                    movie_clip.parse()
-
-                    self.clips.append(movie_clip)
-                elif tag in [7, 15, 20, 21, 25, 33]:  # Text Fields
-                    text_field = TextField(data, tag)
-                    text_field.parse()
-
-                    self.text_fields.append(text_field)
-                elif tag in [8]:  # Matrix
-                    matrix = Matrix(data, tag)
-                    matrix.parse()
-
-                    self.matrix.append(matrix)
-                elif tag in [9]:  # Color Transformation
-                    color = Color(data, tag)
-                    color.parse()
-
-                    self.color_transformations.append(color)
-                # elif tag in [13]:
-                #     pass
-                # elif tag in [19, 24, 27]:
-                #     pass
-                # elif tag in [23]:
-                #     pass
-                # elif tag in [26]:
-                #     pass
-                # elif tag in [30]:
-                #     pass
-                # elif tag in [32]:
-                #     pass
-                # else:
-                #     print(tag, data)
+            with self.metrics.phase('tag_scan') as phase:
+                start = self.tell()
+                while self.remaining() >= 5:
+                    tag = self.readUByte()
+                    length = self.readUInt32()
+
+                    tag_type = TAGS.get(tag)
+                    self.metrics.tag(tag, tag_type is not None or tag == END_TAG).add(length)
+
+                    chunk_id = None
+                    if tag_type is not None and tag_type.has_id:
+                        chunk_id = self.readUShort()
+                        self.skip(-2)
+
+                    self.index.append(ChunkEntry(tag, self.tell(), length, chunk_id))
+                    self.skip(length)
+                phase.add(self.tell() - start, len(self.index))
+
+            # Shapes, clips and text fields are only parsed when first looked up by id
+            lazy_chunks = {}
+            if lazy:
+                self.lazy = True
+                self.shapes = LazyChunks(self.buffer, Shape, textures=self.textures)
+                self.clips = LazyChunks(self.buffer, MovieClip)
+                self.text_fields = LazyChunks(self.buffer, TextField)
+
+                lazy_chunks = {tag: getattr(self, tag_type.collection) for tag, tag_type in TAGS.items()
+                               if tag_type.has_id}
+
+            for entry in self.index:
+                progressbar(entry.offset, len(self.buffer), 'Data Parsing...')
+
+                tag = entry.tag
+                if tag in lazy_chunks:
+                    lazy_chunks[tag].add(entry)
+                    continue
+
+                # A view of the buffer, the payload of unknown chunks is never copied or parsed
+                data = self.buffer[entry.offset:entry.offset + entry.length]
+
+                tag_type = TAGS.get(tag)
+                if tag_type is None:
+                    self.chunks.append(ScObject(data, tag))
+                    continue
+
+                start = time.perf_counter()
+                chunk = tag_type.chunk_type(data, tag)
+                chunk.parse(textures=self.textures)
+                self.metrics.tag_time(tag, time.perf_counter() - start)
+
+                getattr(self, tag_type.collection).append(chunk)
+                self.chunks.append(chunk)
+            progressbar(len(self.buffer) - 1, len(self.buffer), 'Data Parsing...')
 
             print()
             print('-' * 30)
@@ -249,71 +331,304 @@ class SC(ScObject):
                   f'Color Transforms: {len(self.color_transformations) == self.color_transformations_count}',
                   sep='\n')
 
+            unknown_tags = sorted(self.metrics.unknown_tags)
+            if unknown_tags:
+                tags = self.metrics.tags
+                print('Unknown tags:', ', '.join(f'{tag} ({tags[tag].items}x, {tags[tag].bytes} bytes)' for tag in unknown_tags))
+
+            if self.cache is not None and not lazy:
+                with self.metrics.phase('cache_store') as phase:
+                    arrays = pack_graph(self)
+                    self.cache.store(self.cache_key, arrays)
+                    phase.add(sum(array.nbytes for array in arrays.values()))
+
+    def save(self, path: str, signature: str = 'sc'):
+        """Serializes the parsed chunks back into a compressed .sc file.
+
+        Chunks are written in the order of self.chunks, so a file that was
+        parsed and saved without changes comes out the same. A file loaded
+        from the parse cache builds all of its chunks first.
+        """
+        if self.is_texture:
+            raise TypeError('Texture files can not be serialized.')
+        if self.lazy and self.graph is None:
+            raise TypeError('Lazily parsed files can not be serialized.')
+
+        chunks = self.graph.chunks() if self.graph is not None else self.chunks
+
+        writer = ScWriter()
+        for chunk_type in [Shape, MovieClip, Texture, TextField, Matrix, Color]:
+            writer.writeUShort(sum(isinstance(chunk, chunk_type) for chunk in chunks))
+
+        writer.writeInt32(self.unknown_integer)
+        writer.writeByte(self.unknown_byte)
+
+        writer.writeUShort(len(self.exports))
+        for export in self.exports:
+            writer.writeUShort(export.id)
+        for export in self.exports:
+            writer.writeString(export.name)
+
+        textures = [chunk for chunk in chunks if isinstance(chunk, Texture)]
+        for chunk in chunks:
+            writer.writeChunk(chunk.tag, chunk, textures=textures)
+
+        if not chunks or chunks[-1].tag != 0:
+            writer.writeUByte(0)
+            writer.writeUInt32(0)
+
+        with open(path, 'wb') as fh:
+            fh.write(Compressor().compress(bytes(writer.buffer), signature))
+
 
 class Unpacker(CustomObject):
-    def __init__(self, data: SC):
+    def __init__(self, data: SC, textures: list = None, export_names: list = None,
+                 render_cache_size: int = 256 << 20, encoders: int = 4, image_format: str = 'png',
+                 sprite_sheet: bool = False, composite: bool = False, animation: str = None):
         self.export_path = 'sprites'
         self.textures = []
         self.binds = []
-
-        textures_path = 'png/' + data.basename + '_tex/'
-        for file in os.listdir(textures_path):
-            texture = Image.open(open(textures_path + file, 'rb'))
-            self.textures.append(texture)
-
-        data.clips = {clip.id: clip for clip in data.clips}
-        data.shapes = {shape.id: shape for shape in data.shapes}
-        data.text_fields = {text_field.id: text_field for text_field in data.text_fields}
+        self.region_cache = RegionCache(render_cache_size)
+        self.sprite_writer = SpriteWriter(encoders, metrics=data.metrics, image_format=image_format)
+        self.sprite_sheet = sprite_sheet
+        self.composite = composite or animation is not None
+        self.animation = animation
+        self.render_cache_size = render_cache_size
+        self.graph = {}
+        self.order = {}
+
+        if textures is not None:
+            self.textures = textures
+        else:
+            textures_path = 'png/' + data.output_name + '_tex/' + data.basename + '_tex'
+            while os.path.exists(textures_path + '_' * len(self.textures) + '.png'):
+                texture = Image.open(open(textures_path + '_' * len(self.textures) + '.png', 'rb'))
+                self.textures.append(texture)
+
+        if not data.lazy:
+            data.clips = {clip.id: clip for clip in data.clips}
+            data.shapes = {shape.id: shape for shape in data.shapes}
+            data.text_fields = {text_field.id: text_field for text_field in data.text_fields}
         self.data = data
+        self.colors = ColorTransforms(data.color_transformations)
+        self.compositor = Compositor(data, self.textures, self.colors) if self.composite else None
 
-        for export in self.data.exports:
-            self.parse_export(export)
+        exports = [export for export in self.data.exports if export_names is None or export.name in export_names]
+        self.build_graph([export.id for export in exports if export.id in self.data.clips])
+
+        try:
+            for export in exports:
+                self.parse_export(export)
+        finally:
+            self.sprite_writer.close()
 
     def parse_export(self, export: Export):
-        export_name = export.name
+        export_name = export.name or ''
         export_id = export.id
         self.binds = {}
 
-        self.export_path = 'sprites/' + self.data.basename + '/' + export_name + '/'
+        self.export_path = 'sprites/' + self.data.output_name + '/' + export_name + '/'
 
         clip = self.data.clips[export_id]
 
-        del clip.transforms[1:]
-        del clip.binds[1:]
+        if self.animation is not None:
+            self.animate_export(clip)
+            return
+        elif self.composite:
+            self.composite_export(clip)
+            return
+
+        clip.truncate_binds(1)
+        self.graph[export_id] = self.graph[export_id][:1]
 
         print(export_name, '-->', clip)
         regions = self.parse_movie_clip(clip)
-        self.save_region(regions, '')
+
+        os.makedirs(self.export_path, exist_ok=True)
+        if self.sprite_sheet:
+            sheet = SpriteSheet()
+            for path, image in self.iter_sprites(regions):
+                sheet.add(os.path.basename(path), image)
+
+            image, manifest = sheet.render()
+            self.sprite_writer.save(image, self.export_path + 'sheet')
+            with open(self.export_path + 'sheet.json', 'w') as fh:
+                json.dump({
+                    'image': 'sheet' + IMAGE_FORMATS[self.sprite_writer.image_format][0],
+                    'sprites': manifest
+                }, fh, indent=4)
+        else:
+            for path, image in self.iter_sprites(regions):
+                self.sprite_writer.save(image, path)
+
+    def composite_export(self, clip):
+        """Renders the first frame of a clip with all its transforms applied.
+
+        frame.json records where the clip origin lies on the image.
+        """
+        os.makedirs(self.export_path, exist_ok=True)
+
+        with self.data.metrics.phase('composite') as phase:
+            image, origin = self.compositor.render_frame(clip)
+            phase.add(self.region_cache.image_size(image))
+
+        self.sprite_writer.save(image, self.export_path + 'frame_0')
+        with open(self.export_path + 'frame.json', 'w') as fh:
+            json.dump({
+                'frames': [{
+                    'image': 'frame_0' + IMAGE_FORMATS[self.sprite_writer.image_format][0],
+                    'x': origin[0],
+                    'y': origin[1]
+                }]
+            }, fh, indent=4)
+
+    def animate_export(self, clip):
+        """Renders every frame of a clip, played at its frame rate.
+
+        apng and gif write one animation file, frames a numbered image per
+        frame; frame.json records the frame rate and where the clip origin
+        lies on the images.
+        """
+        os.makedirs(self.export_path, exist_ok=True)
+        fps = clip.clip_fps if clip.clip_fps > 0 else 24
+
+        with self.data.metrics.phase('composite') as phase:
+            images, origin = self.compositor.render_animation(clip, self.render_cache_size)
+            phase.add(sum(self.region_cache.image_size(image) for image in images), len(images))
+
+        if self.animation in ANIMATION_FORMATS:
+            with self.data.metrics.phase('animation_encode') as phase:
+                path = save_animation(images, self.export_path + 'animation', fps, self.animation)
+                phase.add(os.path.getsize(path), len(images))
+
+            frames = {'animation': os.path.basename(path), 'frames': len(images), 'x': origin[0], 'y': origin[1]}
+        else:
+            extension = IMAGE_FORMATS[self.sprite_writer.image_format][0]
+            for i, image in enumerate(images):
+                self.sprite_writer.save(image, self.export_path + f'frame_{i}')
+
+            frames = {'frames': [
+                {'image': f'frame_{i}' + extension, 'x': origin[0], 'y': origin[1]} for i in range(len(images))
+            ]}
+
+        with open(self.export_path + 'frame.json', 'w') as fh:
+            json.dump({'fps': fps, **frames}, fh, indent=4)
+
+    def build_graph(self, roots: list):
+        """Collects the binds of every clip reachable from roots and orders the clips children first.
+
+        A bind back to a clip that is still being walked would make the
+        hierarchy infinite, so it is reported and replaced with None.
+        """
+        visiting = set()
+
+        for root in roots:
+            if root in self.order:
+                continue
+
+            self.graph[root] = self.data.clips[root].bind_ids.tolist()
+            visiting.add(root)
+            stack = [(root, enumerate(self.graph[root]))]
+            while stack:
+                clip_id, binds = stack[-1]
+                for bind_index, bind_id in binds:
+                    if bind_id not in self.data.clips or bind_id in self.order:
+                        continue
+
+                    if bind_id in visiting:
+                        print('Cyclic bind', clip_id, '->', bind_id)
+                        self.graph[clip_id][bind_index] = None
+                        continue
+
+                    self.graph[bind_id] = self.data.clips[bind_id].bind_ids.tolist()
+                    visiting.add(bind_id)
+                    stack.append((bind_id, enumerate(self.graph[bind_id])))
+                    break
+                else:
+                    stack.pop()
+                    visiting.remove(clip_id)
+                    self.order[clip_id] = len(self.order)
 
     def parse_movie_clip(self, clip):
-        regions = []
-
-        for bind in clip.binds:
-            bind_id = bind['bind_id']
-            if bind_id in self.data.clips:
-                bind_data = self.data.clips[bind_id]
-                to_append_regions = self.parse_movie_clip(bind_data)
-                regions.append(to_append_regions)
-            elif bind_id in self.data.shapes:
-                shape = self.data.shapes[bind_id]
-
-                for region in shape.regions:
-                    region = self.draw_region(region)
-                    regions.append(region)
-            elif bind_id in self.data.text_fields:
-                text_field = self.data.text_fields[bind_id]
-            else:
-                print(bind_id)
+        reachable = {clip.id}
+        stack = [clip.id]
+        while stack:
+            for bind_id in self.graph[stack.pop()]:
+                if bind_id in self.graph and bind_id not in reachable:
+                    reachable.add(bind_id)
+                    stack.append(bind_id)
+
+        clip_regions = {}
+        for clip_id in sorted(reachable, key=self.order.__getitem__):
+            regions = []
+
+            bind_colors = self.bind_colors(self.data.clips[clip_id])
+            for bind_id, color_id in zip(self.graph[clip_id], bind_colors):
+                if bind_id is None:
+                    continue
+                elif bind_id in self.data.clips:
+                    regions.append((clip_regions[bind_id], color_id))
+                elif bind_id in self.data.shapes:
+                    shape = self.data.shapes[bind_id]
+                    regions.extend((region, color_id) for region in shape.regions)
+                elif bind_id in self.data.text_fields:
+                    text_field = self.data.text_fields[bind_id]
+                else:
+                    print(bind_id)
 
-        return regions
+            clip_regions[clip_id] = regions
 
-    def draw_region(self, region):
+        return clip_regions[clip.id]
+
+    @staticmethod
+    def bind_colors(clip) -> list:
+        """Returns the color transform id of every bind, from the first transform showing it, or None."""
+        colors = [None] * len(clip.bind_ids)
+        for bind_index, _, color_id in clip.transforms[::-1].tolist():
+            if bind_index < len(colors):
+                colors[bind_index] = None if color_id == 0xFFFF else color_id
+        return colors
+
+    def draw_region(self, region, color_ids: tuple = ()):
         texture = self.textures[region.texture_id]
 
         polygon = [(round(point.x), round(point.y)) for point in region.shape_points]
+
+        key = self.region_cache.key(region.texture_id, polygon, color_ids)
+        cached = self.region_cache.get(key)
+        if cached is not None:
+            return cached
+
+        if color_ids:
+            region = self.draw_region(region)
+
+            transform = self.colors.get(color_ids)
+            if transform is not None:
+                with self.data.metrics.phase('color') as phase:
+                    region = apply_color(region, *transform)
+                    phase.add(self.region_cache.image_size(region))
+
+            self.region_cache.put(key, region)
+            return region
+
+        with self.data.metrics.phase('region_cut') as phase:
+            region = self.cut_region(texture, polygon)
+            phase.add(self.region_cache.image_size(region))
+
+        self.region_cache.put(key, region)
+        return region
+
+    def cut_region(self, texture, polygon):
+        # The mask only spans the polygon bounds, plus one pixel for the degenerate polygon shift below.
+        # Pillow rounds polygon edges differently when x is shifted, so only the rows are moved to the origin.
+        top = max(min(y for x, y in polygon), 0)
+        right = min(max(x for x, y in polygon) + 2, texture.size[0])
+        bottom = min(max(y for x, y in polygon) + 2, texture.size[1])
+        polygon = [(x, y - top) for x, y in polygon]
+
         size = (
-            texture.size[0],
-            texture.size[1]
+            max(right, 0),
+            max(bottom - top, 0)
         )
 
         imMask = Image.new('L', size, 0)
@@ -325,35 +640,226 @@ class Unpacker(CustomObject):
             bbox = imMask.getbbox()
         region_size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
         tmpRegion = Image.new('RGBA', region_size, None)
-        tmpRegion.paste(texture.crop(bbox), None, imMask.crop(bbox))
+        texture_bbox = (bbox[0], bbox[1] + top, bbox[2], bbox[3] + top)
+        tmpRegion.paste(texture.crop(texture_bbox), None, imMask.crop(bbox))
 
         return tmpRegion
 
-    def save_region(self, region, export_name):
-        if not os.path.exists(self.export_path):
-            os.makedirs(self.export_path)
+    def iter_sprites(self, regions: list):
+        """Yields (path, image) for every region of a nested region list, cutting each one as it is reached.
+
+        Entries are (region or list, color id) pairs. A region is named after
+        its index in every enclosing list, innermost first, and tinted by the
+        color transforms of all enclosing binds. Paths have no extension, the
+        output format adds it.
+        """
+        stack = [(regions, '', ())]
+        while stack:
+            region, export_name, color_ids = stack.pop()
+            if type(region) is list:
+                for index in reversed(range(len(region))):
+                    sub_region, color_id = region[index]
+                    sub_color_ids = color_ids if color_id is None else color_ids + (color_id,)
+                    stack.append((sub_region, str(index) + export_name, sub_color_ids))
+            else:
+                yield self.export_path + export_name, self.draw_region(region, color_ids)
+
+
+def find_files(directory: str) -> list:
+    """Returns (folder, basename) for every .sc / _tex.sc pair under directory."""
+    pairs = set()
+    for folder, _, filenames in os.walk(directory):
+        for filename in filenames:
+            basename, extension = os.path.splitext(filename)
+            if extension != '.sc':
+                continue
+
+            if basename.endswith('_tex'):
+                basename = basename[:-len('_tex')]
+            pairs.add((folder, basename))
+    return sorted(pairs)
+
+
+def unpack(folder: str, basename: str, stream: bool = False, export_textures: bool = True,
+           export_names: list = None, cache_directory: str = None, cache_size: int = 1 << 30,
+           render_cache_size: int = 256 << 20, metrics_directory: str = None, encoders: int = 4,
+           files: dict = None, metrics: Metrics = None, image_format: str = 'png',
+           sprite_sheet: bool = False, composite: bool = False, animation: str = None,
+           payload_cache_directory: str = None, payload_cache_size: int = 4 << 30, verify_payloads: bool = False,
+           rebuild_payloads: bool = False, root: str = None):
+    """Decodes the textures of one file and exports its sprites.
+
+    files may hold the compressed files by filename, already read. With
+    metrics_directory, the timings of every phase are written to
+    <basename>.json there. With payload_cache_directory, decompressed files
+    are kept there for later runs. With root, the folder the pair was found
+    under, outputs mirror the folder of the pair relative to it, so pairs
+    with the same basename in different folders do not overwrite each other.
+    """
+    textures = None
+    files = files or {}
+    output_folder = os.path.relpath(folder, root) if root is not None else ''
+    if output_folder == os.curdir:
+        output_folder = ''
+    if metrics is None:
+        metrics = Metrics(os.path.join(folder, basename))
+
+    payload_cache = None
+    if payload_cache_directory is not None:
+        payload_cache = PayloadCache(payload_cache_directory, payload_cache_size, verify_payloads, rebuild_payloads)
+
+    texture_filename = basename + '_tex.sc'
+    if os.path.exists(os.path.join(folder, texture_filename)):
+        sc = SC(
+            texture_filename, stream, folder, metrics=metrics, payload_cache=payload_cache,
+            compressed=files.get(texture_filename), output_folder=output_folder
+        )
+        sc.parse(export_textures, image_format=image_format)
 
-        if type(region) is list:
-            for sub_region_index in range(len(region)):
-                self.save_region(
-                    region[sub_region_index],
-                    str(sub_region_index) + export_name
-                )
-        else:
-            region.save(self.export_path + str(export_name) + '.png')
+        textures = sc.images
 
+    filename = basename + '.sc'
+    if os.path.exists(os.path.join(folder, filename)):
+        cache = None
+        if cache_directory is not None:
+            cache = ParseCache(cache_directory, cache_size)
 
-if __name__ == '__main__':
-    if not os.path.exists('sc'):
-        os.mkdir('sc')
+        sc = SC(
+            filename, stream, folder, cache, metrics, payload_cache=payload_cache, compressed=files.get(filename),
+            output_folder=output_folder
+        )
+        sc.parse(lazy=cache is None)
+
+        Unpacker(
+            sc, textures, export_names, render_cache_size, encoders, image_format, sprite_sheet, composite, animation
+        )
 
-    # sc = SC('sc_name_tex.sc')
-    # sc.parse()
+    if metrics_directory is not None:
+        metrics_path = os.path.join(metrics_directory, output_folder, basename + '.json')
+        os.makedirs(os.path.dirname(metrics_path), exist_ok=True)
+        metrics.write(metrics_path)
+
+
+def read_files(skip: bool, cached: bool, pair: tuple, result) -> tuple:
+    """First pipeline stage: reads the compressed files of a pair for the worker process.
+
+    With skip, streamed or payload-cached files are opened by the worker
+    itself. With cached, so is the .sc file, which only has to be read if
+    the parse cache misses it.
+    """
+    folder, basename = pair
+    metrics = Metrics(os.path.join(folder, basename))
+
+    filenames = []
+    if not skip:
+        filenames = [basename + '_tex.sc'] if cached else [basename + '_tex.sc', basename + '.sc']
+
+    files = {}
+    for filename in filenames:
+        path = os.path.join(folder, filename)
+        if os.path.exists(path):
+            with metrics.phase('read') as phase:
+                with open(path, 'rb') as fh:
+                    files[filename] = fh.read()
+                phase.add(len(files[filename]))
+    return files, metrics
+
+
+def unpack_files(options: dict, pair: tuple, result: tuple):
+    """Last pipeline stage: decompresses and unpacks the files in a worker process.
+
+    Only the compressed files are sent to the worker, so no decompressed
+    payload is pickled between processes.
+    """
+    files, metrics = result
+    unpack(*pair, files=files, metrics=metrics, **options)
+
+
+def main(arguments: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Unpacks textures and sprites from Supercell .sc files.')
+    parser.add_argument('directory', nargs='?', default='sc', help='folder searched for .sc files (default: sc)')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: CPU count)')
+    parser.add_argument('--stream', action='store_true', help='memory-map and stream-decompress the input files')
+    parser.add_argument('--skip-textures', action='store_true', help='do not write the texture atlases to png/')
+    parser.add_argument('-e', '--export', action='append', dest='exports', metavar='NAME',
+                        help='only export the named clip (can be repeated)')
+    parser.add_argument('--cache', metavar='DIRECTORY', help='cache parsed files in this folder')
+    parser.add_argument('--cache-size', type=int, default=1024, metavar='MB',
+                        help='size limit of the cache folder in megabytes (default: 1024)')
+    parser.add_argument('--payload-cache', metavar='DIRECTORY',
+                        help='keep decompressed files in this folder and memory-map them on later runs')
+    parser.add_argument('--payload-cache-size', type=int, default=4096, metavar='MB',
+                        help='size limit of the payload cache folder in megabytes (default: 4096)')
+    parser.add_argument('--verify-payloads', action='store_true',
+                        help='check cached payloads against their checksum and rebuild broken ones')
+    parser.add_argument('--rebuild-payloads', action='store_true',
+                        help='decompress every file again and replace its cached payload')
+    parser.add_argument('--render-cache-size', type=int, default=256, metavar='MB',
+                        help='memory kept for rendered regions per file in megabytes (default: 256)')
+    parser.add_argument('--encoders', type=int, default=4, metavar='THREADS',
+                        help='PNG encoder threads per worker process (default: 4)')
+    parser.add_argument('--format', choices=list(IMAGE_FORMATS), default='png',
+                        help='image format of textures and sprites: png, png-fast (lowest compression), '
+                             'webp (lossless) or raw (pixel bytes and a JSON header) (default: png)')
+    parser.add_argument('--sprite-sheet', action='store_true',
+                        help='pack the sprites of every export into one sheet with a JSON manifest')
+    parser.add_argument('--composite', action='store_true',
+                        help='render the first frame of every export with its transforms applied, '
+                             'instead of exporting its regions one by one')
+    parser.add_argument('--animation', choices=list(ANIMATION_FORMATS) + ['frames'],
+                        help='render every frame of every export at the clip frame rate, as an apng or gif '
+                             'animation or as numbered frames in --format (implies --composite)')
+    parser.add_argument('--metrics', metavar='DIRECTORY',
+                        help='write a JSON report with the timings of every phase per file to this folder')
+    args = parser.parse_args(arguments)
+
+    if not os.path.exists(args.directory):
+        os.mkdir(args.directory)
+
+    options = {
+        'stream': args.stream,
+        'export_textures': not args.skip_textures,
+        'export_names': args.exports,
+        'cache_directory': args.cache,
+        'cache_size': args.cache_size * 1024 * 1024,
+        'render_cache_size': args.render_cache_size * 1024 * 1024,
+        'metrics_directory': args.metrics,
+        'encoders': args.encoders,
+        'image_format': args.format,
+        'sprite_sheet': args.sprite_sheet,
+        'composite': args.composite,
+        'animation': args.animation,
+        'payload_cache_directory': args.payload_cache,
+        'payload_cache_size': args.payload_cache_size * 1024 * 1024,
+        'verify_payloads': args.verify_payloads,
+        'rebuild_payloads': args.rebuild_payloads,
+        'root': args.directory
+    }
+    pairs = find_files(args.directory)
+
+    failed = []
+
+    def report(pair: tuple, result):
+        name = os.path.join(*pair)
+        if isinstance(result, Exception):
+            failed.append(name)
+            print(f'\n[FAILED] {name}: {result!r}')
+        else:
+            print(f'\n[OK] {name}')
 
-    # sc = SC('sc_name.sc')
-    # sc.parse()
+    # Reading and unpacking of different files overlap
+    skip_reading = args.stream or args.payload_cache is not None
+    with ThreadPoolExecutor(2) as read_executor, ProcessPoolExecutor(args.workers) as unpack_executor:
+        asyncio.run(run_pipeline(pairs, [
+            Stage(partial(read_files, skip_reading, args.cache is not None), read_executor, 2),
+            Stage(partial(unpack_files, options), unpack_executor, args.workers)
+        ], report, args.workers))
 
     print()
-    print()
+    print(f'Unpacked: {len(pairs) - len(failed)}, Failed: {len(failed)}')
+    return 1 if failed else 0
 
-    unpacker = Unpacker(sc)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+import hashlib
+import io
+import os
+import zipfile
+
+import numpy as np
+
+from utils.files import write_atomic
+from utils.stream import map_file
+
+
+PARSER_VERSION = 6
+
+HASH_BLOCK_SIZE = 1 << 20
+
+CHECKSUM_SIZE = 32
+
+
+def hash_file(path: str, salt: bytes = b'') -> str:
+    digest = hashlib.sha256(salt)
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def checksum(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=CHECKSUM_SIZE).digest()
+
+
+class DiskCache:
+    """A folder of cache entries, evicted oldest first once it grows beyond max_size bytes.
+
+    Using an entry marks it as recently used.
+    """
+
+    extension = ''
+
+    def __init__(self, directory: str = 'cache', max_size: int = 1 << 30):
+        self.directory = directory
+        self.max_size = max_size
+
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.extension)
+
+    def remove(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(self.extension):
+                stat = os.stat(os.path.join(self.directory, filename))
+                entries.append((stat.st_mtime, stat.st_size, filename))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            # Entries still mapped by another process can not be removed on Windows
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError:
+                continue
+            total_size -= size
+
+
+class ParseCache(DiskCache):
+    """On-disk cache of parsed SC object graphs.
+
+    Entries are keyed by a hash of the compressed file and PARSER_VERSION,
+    so a changed file or parser never hits a stale entry. An entry is an
+    uncompressed .npz of the flat arrays of utils.graph.pack_graph, loaded
+    without pickle, so a shared cache folder holds data only.
+    """
+
+    extension = '.graph'
+
+    def key(self, path: str) -> str:
+        return hash_file(path, PARSER_VERSION.to_bytes(4, 'little'))
+
+    def load(self, key: str):
+        """Returns the arrays of an entry by name, or None if there is no readable one."""
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            return None
+
+        os.utime(path)
+        return arrays
+
+    def store(self, key: str, arrays: dict):
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        write_atomic(self.path(key), buffer.getbuffer())
+        self.evict()
+
+
+class PayloadCache(DiskCache):
+    """On-disk cache of decompressed SC files, memory-mapped when reused.
+
+    Entries are keyed by a hash of the compressed file and end with a
+    checksum of the payload. With verify, the checksum of every entry is
+    checked before it is used and broken entries are dropped; with
+    rebuild, existing entries are ignored and written again.
+    """
+
+    extension = '.payload'
+
+    def __init__(self, directory: str = 'cache', max_size: int = 4 << 30, verify: bool = False,
+                 rebuild: bool = False):
+        super().__init__(directory, max_size)
+        self.verify = verify
+        self.rebuild = rebuild
+
+    def key(self, path: str) -> str:
+        return hash_file(path)
+
+    def load(self, key: str):
+        """Returns the payload as a read-only view of the mapped entry, or None if there is none."""
+        if self.rebuild:
+            return None
+
+        path = self.path(key)
+        try:
+            mapped = map_file(path)
+        except (OSError, ValueError):
+            return None
+
+        payload = memoryview(mapped)[:-CHECKSUM_SIZE]
+        if len(mapped) < CHECKSUM_SIZE or self.verify and checksum(payload) != mapped[-CHECKSUM_SIZE:]:
+            payload.release()
+            mapped.close()
+            self.remove(key)
+            return None
+
+        os.utime(path)
+        return payload
+
+    def store(self, key: str, payload: bytes):
+        write_atomic(self.path(key), payload, checksum(payload))
+        self.evict()
@@ -1,11 +1,25 @@
+import struct
+from collections import namedtuple
+from collections.abc import Mapping
+
+import numpy as np
+
 from utils.reader import Reader
+from utils.writer import Writer
 
 
 class CustomObject:
+    __slots__ = ()
+
     def to_dict(self) -> dict:
         dictionary = {}
 
-        for key, value in self.__dict__.items():
+        if hasattr(self, '__dict__'):
+            attributes = self.__dict__
+        else:
+            attributes = {key: getattr(self, key) for key in self.__slots__ if hasattr(self, key)}
+
+        for key, value in attributes.items():
             if key in ['buffer', 'endian', 'i']:
                 continue
             if value is not None:
@@ -45,19 +59,41 @@ class Size(CustomObject):
         self.width = 0
 
 
-class Point(CustomObject):
+POINT = np.dtype([('x', '<f8'), ('y', '<f8')])
+REGION_POINT = np.dtype([('sheet', POINT), ('shape', POINT)])
+
+REGION_HEADER = struct.Struct('<IbB')
+
+
+class ScWriter(Writer):
     def __init__(self):
-        self.x: float
-        self.y: float
+        super().__init__('little')
+
+    def writeString(self, string: str):
+        if string is None:
+            self.writeUByte(255)
+        else:
+            encoded = string.encode('utf-8')
+            self.writeUByte(len(encoded))
+            self.write(encoded)
+
+    def writeChunk(self, tag: int, chunk: 'ScObject', **kwargs):
+        data = ScWriter()
+        chunk.encode(data, **kwargs)
+
+        self.writeUByte(tag)
+        self.writeUInt32(len(data.buffer))
+        self.write(data.buffer)
 
 
 class ScObject(Reader, CustomObject):
     def readString(self) -> str:
+        # A length of 255 marks a null string, which is kept as None so it is written back the same
         length = self.readUByte()
         if length < 255:
             return self.readChar(length)
         else:
-            return ''
+            return None
 
     def __init__(self, buffer: bytes, tag: int = 0):
         super().__init__(buffer, 'little')
@@ -66,6 +102,58 @@ class ScObject(Reader, CustomObject):
     def parse(self, **kwargs):
         pass
 
+    def __getstate__(self) -> dict:
+        # Only the unread tail of the buffer is needed to encode the chunk again
+        state = self.__dict__.copy()
+        state['buffer'] = bytes(self.buffer[self.i:])
+        state['i'] = 0
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.buffer = memoryview(self.buffer)
+
+    def encode(self, writer: ScWriter, **kwargs):
+        writer.write(self.buffer[self.i:])
+
+
+ChunkEntry = namedtuple('ChunkEntry', ['tag', 'offset', 'length', 'id'])
+
+
+class LazyChunks(Mapping):
+    """Maps chunk ids to chunks that are only parsed when first looked up."""
+
+    def __init__(self, buffer: memoryview, chunk_type: type, **kwargs):
+        self.buffer = buffer
+        self.chunk_type = chunk_type
+        self.kwargs = kwargs
+
+        self.entries = {}
+        self.chunks = {}
+
+    def add(self, entry: ChunkEntry):
+        self.entries[entry.id] = entry
+
+    def __getitem__(self, chunk_id: int):
+        chunk = self.chunks.get(chunk_id)
+        if chunk is None:
+            entry = self.entries[chunk_id]
+
+            chunk = self.chunk_type(self.buffer[entry.offset:entry.offset + entry.length], entry.tag)
+            chunk.parse(**self.kwargs)
+
+            self.chunks[chunk_id] = chunk
+        return chunk
+
+    def __contains__(self, chunk_id) -> bool:
+        return chunk_id in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
 
 class Export(ScObject):
     def __init__(self, buffer: bytes = b''):
@@ -81,17 +169,30 @@ class Matrix(ScObject):
         self.matrix: list
 
     def parse(self, **kwargs):
-        v1_1 = self.readInt32() * 0.00097656
-        v2_1 = self.readInt32() * 0.00097656
-        v1_2 = self.readInt32() * 0.00097656
-        v2_2 = self.readInt32() * 0.00097656
-        v1_3 = self.readInt32() * 0.05
-        v2_3 = self.readInt32() * 0.05
+        a, b, c, d, tx, ty = self.readInt32Array(6).tolist()
+
+        v1_1 = a * 0.00097656
+        v2_1 = b * 0.00097656
+        v1_2 = c * 0.00097656
+        v2_2 = d * 0.00097656
+        v1_3 = tx * 0.05
+        v2_3 = ty * 0.05
 
         setattr(self, 'matrix',
                 [v1_1, v1_2, v1_3,
                  v2_1, v2_2, v2_3])
 
+    def encode(self, writer: ScWriter, **kwargs):
+        v1_1, v1_2, v1_3, v2_1, v2_2, v2_3 = getattr(self, 'matrix')
+
+        writer.writeInt32(round(v1_1 / 0.00097656))
+        writer.writeInt32(round(v2_1 / 0.00097656))
+        writer.writeInt32(round(v1_2 / 0.00097656))
+        writer.writeInt32(round(v2_2 / 0.00097656))
+        writer.writeInt32(round(v1_3 / 0.05))
+        writer.writeInt32(round(v2_3 / 0.05))
+        super().encode(writer)
+
 
 class Color(ScObject):
     def __init__(self, buffer: bytes, tag: int):
@@ -106,6 +207,31 @@ class Color(ScObject):
 
         setattr(self, 'color', [r, g, b, a])
 
+    def encode(self, writer: ScWriter, **kwargs):
+        r, g, b, a = getattr(self, 'color')
+
+        writer.writeUShort(r)
+        writer.writeUShort(g)
+        writer.writeUShort(b)
+        writer.writeUByte(a)
+        super().encode(writer)
+
+    def transform(self) -> tuple:
+        """Returns the RGBA multipliers (0 to 1) and additions (0 to 255) of the transform.
+
+        The seven bytes are the red, green and blue additions, the alpha
+        multiplier and the red, green and blue multipliers; color keeps them
+        as read.
+        """
+        r, g, b, a = getattr(self, 'color')
+        red_add, green_add, blue_add, alpha_multiply, red_multiply, green_multiply, blue_multiply = (
+            r.to_bytes(2, 'little') + g.to_bytes(2, 'little') + b.to_bytes(2, 'little') + bytes([a])
+        )
+
+        multiply = np.array([red_multiply, green_multiply, blue_multiply, alpha_multiply], np.float32) / 255
+        add = np.array([red_add, green_add, blue_add, 0], np.float32)
+        return multiply, add
+
 
 class Texture(ScObject):
     def __init__(self, buffer: bytes, tag: int):
@@ -124,69 +250,130 @@ class Texture(ScObject):
         setattr(getattr(self, 'size'), 'width', getattr(self, 'width'))
         setattr(getattr(self, 'size'), 'height', getattr(self, 'height'))
 
+    def encode(self, writer: ScWriter, **kwargs):
+        writer.writeByte(getattr(self, 'image_type'))
+        writer.writeUShort(getattr(self, 'width'))
+        writer.writeUShort(getattr(self, 'height'))
+        super().encode(writer)
+
 
 class MovieClip(ScObject):
+    """A clip timeline stored as typed columns.
+
+    transforms is an (N, 3) uint16 array of (bind_id, bind_matrix,
+    bind_color_id) rows. Frame i uses the transforms between
+    frame_offsets[i] and frame_offsets[i + 1]; frame_ids holds the number
+    of transforms of every frame (tag 11) and frame_names its label.
+    frame_tags and frame_lengths keep every tag of the frame list as read,
+    so the clip can be encoded again.
+    """
+
     def __init__(self, buffer: bytes, tag: int):
         super().__init__(buffer, tag)
         self.id: int
         self.clip_fps: int
         self.frames_count: int
 
-        self.transforms: list
-        self.binds: list
+        self.transforms: np.ndarray
+
+        self.bind_ids: np.ndarray
+        self.bind_opacities: np.ndarray
+        self.bind_names: list
+
+        self.frame_tags: np.ndarray
+        self.frame_lengths: np.ndarray
+        self.frame_ids: np.ndarray
+        self.frame_names: list
+        self.frame_offsets: np.ndarray
 
     def parse(self, **kwargs):
         setattr(self, 'id', self.readUShort())
         setattr(self, 'clip_fps', self.readByte())
         setattr(self, 'frames_count', self.readUShort())
 
-        transforms = []
         count = self.readUInt32()
-        for x in range(count):
-            transforms.append({})
-
-            transforms[x]['bind_id'] = self.readUShort()
-            transforms[x]['bind_matrix'] = self.readUShort()
-            transforms[x]['bind_color_id'] = self.readUShort()
-        setattr(self, 'transforms', transforms)
+        setattr(self, 'transforms', self.readUInt16Array(count * 3).reshape(count, 3).copy())
 
-        binds = []
         count = self.readShort()
-        for x in range(count):
-            binds.append({})
-
-            binds[x]['bind_id'] = self.readUShort()
+        setattr(self, 'bind_ids', self.readUInt16Array(count).copy())
 
+        bind_opacities = None
         if self.tag == 12:
-            for x in range(count):
-                binds[x]['opacity'] = self.readByte()
+            bind_opacities = self.readInt8Array(count).copy()
+        setattr(self, 'bind_opacities', bind_opacities)
 
-        for x in range(count):
-            binds[x]['bind_name'] = self.readString()
-        setattr(self, 'binds', binds)
+        setattr(self, 'bind_names', [self.readString() for x in range(count)])
 
-        unk_array = []
+        frame_tags = []
+        frame_lengths = []
+        frame_ids = []
+        frame_names = []
         while True:
-            while True:
-                while True:
-                    unk_array.append({})
-
-                    unk_tag = self.readUByte()
-                    unk_length = self.readUInt32()
-
-                    unk_array[len(unk_array) - 1]['unk_tag'] = unk_tag
-                    unk_array[len(unk_array) - 1]['unk_length'] = unk_length
-
-                    if unk_tag != 5:
-                        break
-                if unk_tag == 11:
-                    unk_array[len(unk_array) - 1]['frame_id'] = self.readShort()
-                    unk_array[len(unk_array) - 1]['frame_name'] = self.readString()
-                else:
-                    break
-            if unk_tag == 0:
+            frame_tag = self.readUByte()
+
+            frame_tags.append(frame_tag)
+            frame_lengths.append(self.readUInt32())
+
+            if frame_tag == 11:
+                frame_ids.append(self.readShort())
+                frame_names.append(self.readString())
+            elif frame_tag == 0:
                 break
 
+        setattr(self, 'frame_tags', np.array(frame_tags, np.uint8))
+        setattr(self, 'frame_lengths', np.array(frame_lengths, np.uint32))
+        setattr(self, 'frame_ids', np.array(frame_ids, np.int16))
+        setattr(self, 'frame_names', frame_names)
+
+        frame_offsets = np.zeros(len(frame_ids) + 1, np.uint32)
+        np.cumsum(np.maximum(self.frame_ids, 0), out=frame_offsets[1:])
+        setattr(self, 'frame_offsets', frame_offsets)
+
+    def frame_transforms(self, frame: int) -> np.ndarray:
+        return self.transforms[self.frame_offsets[frame]:self.frame_offsets[frame + 1]]
+
+    def truncate_binds(self, count: int):
+        self.transforms = self.transforms[:count]
+        self.bind_ids = self.bind_ids[:count]
+        if self.bind_opacities is not None:
+            self.bind_opacities = self.bind_opacities[:count]
+        self.bind_names = self.bind_names[:count]
+
+    def encode(self, writer: ScWriter, **kwargs):
+        writer.writeUShort(getattr(self, 'id'))
+        writer.writeByte(getattr(self, 'clip_fps'))
+        writer.writeUShort(getattr(self, 'frames_count'))
+
+        transforms = getattr(self, 'transforms')
+        writer.writeUInt32(len(transforms))
+        writer.write(transforms.astype('<u2').tobytes())
+
+        bind_ids = getattr(self, 'bind_ids')
+        writer.writeShort(len(bind_ids))
+        writer.write(bind_ids.astype('<u2').tobytes())
+
+        if self.tag == 12:
+            writer.write(getattr(self, 'bind_opacities').astype('i1').tobytes())
+
+        for bind_name in getattr(self, 'bind_names'):
+            writer.writeString(bind_name)
+
+        frames = zip(getattr(self, 'frame_ids').tolist(), getattr(self, 'frame_names'))
+        for frame_tag, frame_length in zip(getattr(self, 'frame_tags').tolist(), getattr(self, 'frame_lengths').tolist()):
+            writer.writeUByte(frame_tag)
+            if frame_tag == 11:
+                frame_id, frame_name = next(frames)
+
+                frame_data = ScWriter()
+                frame_data.writeShort(frame_id)
+                frame_data.writeString(frame_name)
+
+                writer.writeUInt32(len(frame_data.buffer))
+                writer.write(frame_data.buffer)
+            else:
+                writer.writeUInt32(frame_length)
+        super().encode(writer)
+
 
 class TextField(ScObject):
     def __init__(self, buffer: bytes, tag: int):
@@ -198,14 +385,60 @@ class TextField(ScObject):
         setattr(self, 'id', self.readUShort())
         setattr(self, 'font', self.readString())
 
+    def encode(self, writer: ScWriter, **kwargs):
+        writer.writeUShort(getattr(self, 'id'))
+        writer.writeString(getattr(self, 'font'))
+        super().encode(writer)
+
+
+def decode_points(sheet: np.ndarray, uv: np.ndarray, region_tags: np.ndarray, counts: np.ndarray,
+                  sizes: np.ndarray) -> np.ndarray:
+    """Decodes raw (x, y) sheet and (u, v) texture coordinates into a REGION_POINT array.
+
+    Regions are given by their tag, number of points and texture size;
+    tag 22 stores uv as fractions of the texture size.
+    """
+    points = np.empty((len(sheet), 4))
+    points[:, :2] = sheet
+    points[:, :2] *= 0.05
+    points[:, 2:] = uv
+
+    scaled = np.repeat(region_tags == 22, counts)
+    if scaled.any():
+        point_sizes = np.repeat(sizes, counts, 0)[scaled]
+        points[scaled, 2:] = points[scaled, 2:] / 65535 * point_sizes
+    return points.view(REGION_POINT).reshape(-1)
+
+
+def encode_points(points: np.ndarray, region_tags: np.ndarray, counts: np.ndarray, sizes: np.ndarray) -> tuple:
+    """The inverse of decode_points: returns the raw sheet and uv coordinates of a REGION_POINT array."""
+    sheet = np.stack([points['sheet']['x'], points['sheet']['y']], 1)
+    uv = np.stack([points['shape']['x'], points['shape']['y']], 1)
+
+    scaled = np.repeat(region_tags == 22, counts)
+    uv[scaled] = uv[scaled] / np.repeat(sizes, counts, 0)[scaled] * 65535
+    return np.round(sheet / 0.05).astype('<i4'), np.round(uv).astype('<u2')
+
 
 class Shape(ScObject):
+    """A shape and its textured regions.
+
+    The points of all regions live in one structured array; region i owns
+    points[region_offsets[i]:region_offsets[i + 1]] and every Region is a
+    view on its part of it.
+    """
+
     def __init__(self, buffer: bytes, tag: int):
         super().__init__(buffer, tag)
         self.id: int
         self.regions_count: int
         self.points_count: int
 
+        self.region_tags: np.ndarray
+        self.texture_ids: np.ndarray
+        self.region_offsets: np.ndarray
+        self.points: np.ndarray
+
         self.regions: list
 
     def parse(self, **kwargs):
@@ -213,59 +446,105 @@ class Shape(ScObject):
         setattr(self, 'regions_count', self.readUShort())
         setattr(self, 'points_count', self.readUShort())
 
-        regions = []
+        textures = kwargs['textures']
+        region_tags = []
+        texture_ids = []
+        counts = []
+        sheet_points = []
+        shape_points = []
+        sizes = []
         for x in range(getattr(self, 'regions_count')):
             chunk_type = self.readUByte()
             if chunk_type in [17, 22]:
-                chunk_length = self.readUInt32()
-                region_data = self.read(chunk_length)
-                region = Region(region_data, chunk_type)
-                region.parse(textures=kwargs['textures'])
-
-                regions.append(region)
+                chunk_length, texture_id, points_count = REGION_HEADER.unpack_from(self.buffer, self.i)
+                chunk_end = self.i + 4 + chunk_length
+                self.i += REGION_HEADER.size
+
+                region_tags.append(chunk_type)
+                texture_ids.append(texture_id)
+                counts.append(points_count)
+                sheet_points.append(self.read(points_count * 8))
+                shape_points.append(self.read(points_count * 4))
+
+                texture = textures[texture_id]
+                sizes.append((texture.size.width, texture.size.height))
+                self.i = chunk_end
             if chunk_type == 0:
                 break
-        setattr(self, 'regions', regions)
 
+        # All regions are decoded at once, from their raw coordinates joined together
+        region_offsets = np.zeros(len(counts) + 1, np.uint32)
+        region_offsets[1:] = counts
+        region_offsets = np.cumsum(region_offsets, dtype=np.uint32)
+
+        points = decode_points(
+            np.frombuffer(b''.join(sheet_points), '<i4').reshape(-1, 2),
+            np.frombuffer(b''.join(shape_points), '<u2').reshape(-1, 2),
+            np.array(region_tags, np.uint8), np.array(counts), np.array(sizes, np.float64).reshape(-1, 2)
+        )
+
+        setattr(self, 'region_tags', np.array(region_tags, np.uint8))
+        setattr(self, 'texture_ids', np.array(texture_ids, np.int8))
+        setattr(self, 'region_offsets', region_offsets)
+        setattr(self, 'points', points)
+        self.build_regions()
+
+    def build_regions(self):
+        """Creates the Region views on the point array."""
+        offsets = self.region_offsets.tolist()
+        setattr(self, 'regions', [
+            Region(tag, texture_id, self.points[offsets[i]:offsets[i + 1]])
+            for i, (tag, texture_id) in enumerate(zip(self.region_tags.tolist(), self.texture_ids.tolist()))
+        ])
+
+    def encode(self, writer: ScWriter, **kwargs):
+        writer.writeUShort(getattr(self, 'id'))
+        writer.writeUShort(len(getattr(self, 'regions')))
+        writer.writeUShort(getattr(self, 'points_count'))
+
+        for region in getattr(self, 'regions'):
+            writer.writeChunk(region.tag, region, textures=kwargs['textures'])
+        super().encode(writer)
+
+
+class Region(CustomObject):
+    """A textured polygon of a shape.
+
+    Sheet and shape (texture) coordinates of every point live side by side
+    in a structured array, a view on the points of its shape; sheet_points
+    and shape_points are record views on it, so callers can still read
+    point.x and point.y.
+    """
+
+    __slots__ = ('tag', 'texture_id', 'points')
+
+    def __init__(self, tag: int, texture_id: int = 0, points: np.ndarray = None):
+        self.tag = tag
+        self.texture_id = texture_id
+        self.points = points if points is not None else np.empty(0, REGION_POINT)
 
-class Region(ScObject):
-    def __init__(self, buffer: bytes, tag: int):
-        super().__init__(buffer, tag)
-        self.texture_id: int
-        self.points_count: int
-
-        self.sheet_points: list
-        self.shape_points: list
-
-    def parse(self, **kwargs):
-        setattr(self, 'texture_id', self.readByte())
-        texture = kwargs['textures'][getattr(self, 'texture_id')]
-
-        setattr(self, 'points_count', self.readByte())
-
-        sheet_points = []
-        for i in range(getattr(self, 'points_count')):  # sheet_points
-            point = Point()
-
-            point.x = self.readInt32() * 0.05
-            point.y = self.readInt32() * 0.05
+    @property
+    def points_count(self) -> int:
+        return len(self.points)
 
-            sheet_points.append(point)
-        setattr(self, 'sheet_points', sheet_points)
+    @property
+    def sheet_points(self) -> np.recarray:
+        return self.points['sheet'].view(np.recarray)
 
-        shape_points = []
-        for i in range(getattr(self, 'points_count')):  # sheet_points
-            point = Point()
+    @property
+    def shape_points(self) -> np.recarray:
+        return self.points['shape'].view(np.recarray)
 
-            point.x = self.readUShort()  # u
-            point.y = self.readUShort()  # v
+    def encode(self, writer: ScWriter, **kwargs):
+        texture = kwargs['textures'][self.texture_id]
 
-            if self.tag == 22:
-                point.x /= 65535
-                point.y /= 65535
+        writer.writeByte(self.texture_id)
+        writer.writeUByte(len(self.points))
 
-                point.x *= texture.size.width
-                point.y *= texture.size.height
+        sheet_points = np.stack([self.points['sheet']['x'], self.points['sheet']['y']], 1)
+        writer.write(np.round(sheet_points / 0.05).astype('<i4').tobytes())
 
-            shape_points.append(point)
-        setattr(self, 'shape_points', shape_points)
+        shape_points = np.stack([self.points['shape']['x'], self.points['shape']['y']], 1)
+        if self.tag == 22:
+            shape_points = shape_points / [texture.size.width, texture.size.height] * 65535
+        writer.write(np.round(shape_points).astype('<u2').tobytes())
@@ -0,0 +1,391 @@
+import math
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image, ImageChops, ImageDraw
+
+from utils.render import ColorTransforms, RegionCache, apply_color
+
+
+NO_INDEX = 0xFFFF
+
+Layer = namedtuple('Layer', ['region', 'to_clip', 'texture_to_clip', 'color', 'key'])
+# Regions with their matrices, color ids and vertices, relative to the clip or shape they belong to
+Subtree = namedtuple('Subtree', ['regions', 'to_clip', 'texture_to_clip', 'colors', 'vertices'])
+
+IDENTITY = np.identity(3)
+
+
+class Compositor:
+    """Renders clip frames onto one canvas by applying the Matrix chunks of every bind.
+
+    A frame is first flattened into layers, (region, matrix, color ids) in
+    paint order, together with the vertices of all regions, which size the
+    canvas. Every clip keeps its flattened layers per frame, relative to
+    itself, and a parent places them with one matrix product. Every region is warped straight from its texture
+    into its own bounds on the canvas, in a single resampling step, and
+    tinted by the color transforms of its binds.
+    """
+
+    def __init__(self, data, textures: list, colors: ColorTransforms = None):
+        self.data = data
+        self.textures = textures
+        self.rgba_textures = {}
+        self.colors = colors if colors is not None else ColorTransforms(data.color_transformations)
+        self.periods = {}
+        self.subtrees = {}
+        self.shapes = {}
+
+        self.matrices = np.tile(IDENTITY, (len(data.matrix), 1, 1))
+        for i, matrix in enumerate(data.matrix):
+            self.matrices[i, :2] = np.reshape(matrix.matrix, (2, 3))
+
+    def texture(self, texture_id: int) -> Image.Image:
+        texture = self.rgba_textures.get(texture_id)
+        if texture is None:
+            texture = self.rgba_textures[texture_id] = self.textures[texture_id].convert('RGBA')
+        return texture
+
+    def child_clips(self, clip) -> list:
+        clips = self.data.clips
+        return [clips[bind_id] for bind_id in dict.fromkeys(clip.bind_ids.tolist()) if bind_id in clips]
+
+    def period(self, clip):
+        """Returns after how many frames everything a clip shows repeats.
+
+        That is the least common multiple of the frame counts of all clips it
+        reaches through its binds, or None if those binds reach a cycle.
+        """
+        periods = self.periods
+        if clip.id in periods:
+            return periods[clip.id]
+
+        cyclic = set()
+        path = {clip.id}
+        stack = [(clip, iter(self.child_clips(clip)))]
+        while stack:
+            item, children = stack[-1]
+            for child in children:
+                if child.id in path:
+                    cyclic.update(path)
+                elif child.id not in periods:
+                    path.add(child.id)
+                    stack.append((child, iter(self.child_clips(child))))
+                    break
+            else:
+                stack.pop()
+                path.discard(item.id)
+
+                period = None if item.id in cyclic else max(len(item.frame_ids), 1)
+                for child in self.child_clips(item):
+                    child_period = periods[child.id] if period is not None else None
+                    if child_period is None:
+                        period = None
+                        break
+                    period = period * child_period // math.gcd(period, child_period)
+                periods[item.id] = period
+
+        return periods[clip.id]
+
+    def binds(self, clip, frame: int):
+        """Yields (child, 3x3 matrix, color ids) for the binds a clip shows at a frame, in paint order."""
+        frames = len(clip.frame_ids)
+        transforms = clip.frame_transforms(frame % frames) if frames else clip.transforms
+
+        for bind_index, matrix_index, color_index in transforms.tolist():
+            if bind_index >= len(clip.bind_ids):
+                continue
+            bind_id = int(clip.bind_ids[bind_index])
+
+            matrix = IDENTITY
+            if matrix_index != NO_INDEX and matrix_index < len(self.matrices):
+                matrix = self.matrices[matrix_index]
+            colors = () if color_index == NO_INDEX else (color_index,)
+
+            if bind_id in self.data.clips:
+                yield self.data.clips[bind_id], matrix, colors
+            elif bind_id in self.data.shapes:
+                yield self.data.shapes[bind_id], matrix, colors
+
+    def shape_subtree(self, shape) -> Subtree:
+        """Returns the regions of a shape that can be warped, in its own coordinates."""
+        subtree = self.shapes.get(shape.id)
+        if subtree is None:
+            regions = []
+            texture_matrices = []
+            for region in shape.regions:
+                texture_matrix = self.texture_matrix(region)
+                if texture_matrix is not None:
+                    regions.append(region)
+                    texture_matrices.append(texture_matrix)
+
+            subtree = self.shapes[shape.id] = Subtree(
+                regions, np.tile(IDENTITY, (len(regions), 1, 1)), np.reshape(texture_matrices, (-1, 3, 3)),
+                [()] * len(regions), np.concatenate(
+                    [np.stack([region.points['sheet']['x'], region.points['sheet']['y']], 1) for region in regions]
+                ) if regions else np.empty((0, 2))
+            )
+        return subtree
+
+    def subtree(self, clip, frame: int = 0) -> Subtree:
+        """Flattens a clip frame into the layers it shows, in paint order and clip coordinates.
+
+        Child clips show frame modulo their own frame count. The layers of
+        every clip are kept per frame modulo its period, so a child clip is
+        only flattened again when what it shows changes. A bind back to a
+        clip that is already being drawn is skipped; clips that reach such
+        a cycle are flattened on every call.
+        """
+        if self.period(clip) is None:
+            return self.walk(clip, frame)
+
+        pending = [clip]
+        while pending:
+            item = pending[-1]
+            key = (item.id, frame % self.periods[item.id])
+            if key in self.subtrees:
+                pending.pop()
+                continue
+
+            binds = list(self.binds(item, frame))
+            missing = [
+                child for child, _, _ in binds
+                if child.id in self.periods and (child.id, frame % self.periods[child.id]) not in self.subtrees
+            ]
+            if missing:
+                pending.extend(missing)
+                continue
+
+            self.subtrees[key] = join([
+                transform(
+                    self.subtrees[child.id, frame % self.periods[child.id]] if child.id in self.periods
+                    else self.shape_subtree(child), matrix, colors
+                )
+                for child, matrix, colors in binds
+            ])
+            pending.pop()
+
+        return self.subtrees[clip.id, frame % self.periods[clip.id]]
+
+    def walk(self, clip, frame: int) -> Subtree:
+        """Flattens a clip frame that reaches a cycle, skipping binds back to the clips being drawn."""
+        pieces = []
+
+        stack = [(clip, IDENTITY, (), frozenset())]
+        while stack:
+            item, matrix, colors, ancestors = stack.pop()
+            if isinstance(item, Subtree):
+                pieces.append(transform(item, matrix, colors))
+                continue
+
+            ancestors = ancestors | {item.id}
+
+            children = []
+            for child, child_matrix, child_colors in self.binds(item, frame):
+                child_matrix = matrix @ child_matrix
+                child_colors = colors + child_colors
+
+                if child.id not in self.data.clips:
+                    children.append((self.shape_subtree(child), child_matrix, child_colors, None))
+                elif child.id in ancestors:
+                    continue
+                elif self.period(child) is not None:
+                    children.append((self.subtree(child, frame), child_matrix, child_colors, None))
+                else:
+                    children.append((child, child_matrix, child_colors, ancestors))
+
+            stack.extend(reversed(children))
+
+        return join(pieces)
+
+    @staticmethod
+    def texture_matrix(region):
+        """Returns the 3x3 matrix mapping texture pixels to the local coordinates of a region.
+
+        It follows from the point pairs by least squares; a region whose
+        texture points have no area has none.
+        """
+        if len(region.points) < 3:
+            return None
+
+        shape_points = region.points['shape']
+        uv = np.stack([shape_points['x'], shape_points['y'], np.ones(len(shape_points))], 1)
+        sheet_points = region.points['sheet']
+        local = np.stack([sheet_points['x'], sheet_points['y']], 1)
+
+        matrix, _, rank, _ = np.linalg.lstsq(uv, local, rcond=None)
+        if rank < 3:
+            return None
+        return np.vstack([matrix.T, (0, 0, 1)])
+
+    def frame(self, clip, frame: int = 0) -> tuple:
+        """Returns the layers of a clip frame and the vertices of all of them in clip coordinates."""
+        subtree = self.subtree(clip, frame)
+        layers = [
+            Layer(region, to_clip, texture_to_clip, self.colors.get(color_ids),
+                  (id(region), to_clip.tobytes(), color_ids))
+            for region, to_clip, texture_to_clip, color_ids in zip(
+                subtree.regions, subtree.to_clip, subtree.texture_to_clip, subtree.colors
+            )
+        ]
+        return layers, subtree.vertices
+
+    @staticmethod
+    def bounds(vertices: np.ndarray) -> tuple:
+        left, top = np.floor(vertices.min(0)).astype(int).tolist()
+        right, bottom = np.ceil(vertices.max(0)).astype(int).tolist()
+        return left, top, max(right, left + 1), max(bottom, top + 1)
+
+    def composite(self, layers: list, vertices: np.ndarray, bounds: tuple, cache: RegionCache = None) -> Image.Image:
+        """Draws layers onto a canvas covering bounds in clip coordinates.
+
+        Warped layers are looked up in and added to cache, if given.
+        """
+        left, top, right, bottom = bounds
+        canvas = Image.new('RGBA', (right - left, bottom - top), None)
+        self.draw(canvas, layers, vertices, bounds, cache)
+        return canvas
+
+    def draw(self, canvas: Image.Image, layers: list, vertices: np.ndarray, bounds: tuple, cache: RegionCache = None,
+             start: int = 0, stop: int = None):
+        """Draws layers[start:stop] onto a canvas covering bounds, over what is already on it."""
+        left, top = bounds[:2]
+
+        vertices = vertices - (left, top)
+        offsets = np.cumsum([0] + [len(layer.region.points) for layer in layers])
+        for i in range(start, len(layers) if stop is None else stop):
+            layer = layers[i]
+            layer_vertices = vertices[offsets[i]:offsets[i + 1]]
+            position = tuple(np.floor(layer_vertices.min(0)).astype(int).tolist())
+
+            image = cache.get(layer.key) if cache is not None else None
+            if image is None:
+                to_canvas = layer.texture_to_clip.copy()
+                to_canvas[:2, 2] -= (left, top)
+
+                image = self.warp(layer.region, to_canvas, layer_vertices)
+                if image is None:
+                    continue
+                if layer.color is not None:
+                    image = apply_color(image, *layer.color)
+
+                if cache is not None:
+                    cache.put(layer.key, image)
+            canvas.alpha_composite(image, position)
+
+    def render(self, layers: list, vertices: np.ndarray) -> tuple:
+        """Draws layers onto a canvas just large enough to hold them.
+
+        Returns the canvas and the position of the clip origin on it.
+        """
+        if not layers:
+            return Image.new('RGBA', (1, 1), None), (0, 0)
+
+        bounds = self.bounds(vertices)
+        return self.composite(layers, vertices, bounds), (-bounds[0], -bounds[1])
+
+    def warp(self, region, to_canvas: np.ndarray, vertices: np.ndarray):
+        """Returns the region warped into the bounds of its vertices on the canvas."""
+        if abs(np.linalg.det(to_canvas)) < 1e-9:
+            return None
+
+        left, top = np.floor(vertices.min(0)).astype(int)
+        right, bottom = np.ceil(vertices.max(0)).astype(int)
+        size = (max(right - left, 1), max(bottom - top, 1))
+
+        to_canvas[:2, 2] -= (left, top)
+        to_texture = np.linalg.inv(to_canvas)[:2].ravel()
+
+        image = self.texture(region.texture_id).transform(size, Image.AFFINE, tuple(to_texture), Image.BILINEAR)
+
+        mask = Image.new('L', size, 0)
+        ImageDraw.Draw(mask).polygon([(x - left, y - top) for x, y in vertices.tolist()], fill=255)
+        image.putalpha(ImageChops.multiply(image.getchannel('A'), mask))
+
+        return image
+
+    def render_frame(self, clip, frame: int = 0) -> tuple:
+        return self.render(*self.frame(clip, frame))
+
+    def render_animation(self, clip, cache_size: int = 256 << 20) -> tuple:
+        """Renders every frame of a clip onto canvases of one size.
+
+        Returns the frames and the position of the clip origin on them.
+        A frame starts from a copy of the layers it shares, from the bottom
+        up, with the frame before it, so only the layers from the first
+        changed one on are drawn again. Child clips are only flattened again
+        when what they show changes, warped layers are reused as long as
+        their matrix and color stay the same, and a frame showing the same
+        layers as an earlier one is that frame again.
+        """
+        timeline, vertices = zip(*[self.frame(clip, frame) for frame in range(max(len(clip.frame_ids), 1))])
+
+        if not any(len(layers) for layers in timeline):
+            return [Image.new('RGBA', (1, 1), None)] * len(timeline), (0, 0)
+        left, top, right, bottom = bounds = self.bounds(np.concatenate(vertices))
+
+        keys = [tuple(layer.key for layer in layers) for layers in timeline]
+        shared = [0] + [shared_prefix(keys[i - 1], keys[i]) for i in range(1, len(keys))] + [0]
+
+        cache = RegionCache(cache_size)
+        frames = {}
+        images = []
+        base = None  # (count, canvas holding the first count layers of the last frame)
+        for i, layers in enumerate(timeline):
+            if base is not None and base[0] > shared[i]:
+                base = None
+
+            if keys[i] not in frames:
+                if base is not None:
+                    start, canvas = base[0], base[1].copy()
+                else:
+                    start, canvas = 0, Image.new('RGBA', (right - left, bottom - top), None)
+
+                # Kept for the next frame, which shares the layers below checkpoint
+                checkpoint = shared[i + 1]
+                if checkpoint > start:
+                    self.draw(canvas, layers, vertices[i], bounds, cache, start, checkpoint)
+                    base = (checkpoint, canvas.copy())
+                    start = checkpoint
+                self.draw(canvas, layers, vertices[i], bounds, cache, start)
+
+                frames[keys[i]] = canvas
+            images.append(frames[keys[i]])
+
+        return images, (-left, -top)
+
+
+def shared_prefix(a: tuple, b: tuple) -> int:
+    """Returns how many items a and b have in common from the start."""
+    count = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        count += 1
+    return count
+
+
+def transform(subtree: Subtree, matrix: np.ndarray, colors: tuple) -> Subtree:
+    """Returns subtree as seen from a parent that binds it with matrix and color ids."""
+    if matrix is IDENTITY and not colors:
+        return subtree
+
+    return Subtree(
+        subtree.regions, matrix @ subtree.to_clip, matrix @ subtree.texture_to_clip,
+        [colors + color_ids for color_ids in subtree.colors] if colors else subtree.colors,
+        subtree.vertices @ matrix[:2, :2].T + matrix[:2, 2]
+    )
+
+
+def join(subtrees: list) -> Subtree:
+    """Returns the layers of subtrees painted one after another."""
+    if len(subtrees) == 1:
+        return subtrees[0]
+
+    return Subtree(
+        [region for subtree in subtrees for region in subtree.regions],
+        np.concatenate([subtree.to_clip for subtree in subtrees] + [np.empty((0, 3, 3))]),
+        np.concatenate([subtree.texture_to_clip for subtree in subtrees] + [np.empty((0, 3, 3))]),
+        [color_ids for subtree in subtrees for color_ids in subtree.colors],
+        np.concatenate([subtree.vertices for subtree in subtrees] + [np.empty((0, 2))])
+    )
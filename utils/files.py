@@ -0,0 +1,26 @@
+import os
+import tempfile
+
+
+# Read once at import, changing the umask is not thread safe
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def write_atomic(path: str, *blocks):
+    """Writes the blocks to path one after another, replacing it only once they are all written.
+
+    The file gets the permissions of a file created with open(), not the
+    private ones of a temporary file.
+    """
+    directory = os.path.dirname(path) or '.'
+    fd, temporary_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            for block in blocks:
+                fh.write(block)
+        os.chmod(temporary_path, 0o666 & ~UMASK)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
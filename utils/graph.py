@@ -0,0 +1,271 @@
+import json
+from collections.abc import Mapping
+
+import numpy as np
+
+from utils.chunks import REGION_POINT, Color, Export, Matrix, MovieClip, ScObject, Shape, TextField, Texture, \
+    decode_points, encode_points
+
+
+KINDS = [Texture, Shape, MovieClip, TextField, Matrix, Color]
+KIND_INDEX = {kind: index for index, kind in enumerate(KINDS)}
+RAW = 255
+
+COUNT_ATTRIBUTES = [
+    'shape_count', 'clips_count', 'textures_count', 'text_fields_count', 'matrix_count',
+    'color_transformations_count', 'unknown_integer', 'unknown_byte'
+]
+
+
+def offsets(counts: list) -> np.ndarray:
+    result = np.zeros(len(counts) + 1, np.uint32)
+    np.cumsum(counts, out=result[1:])
+    return result
+
+
+def concatenate(arrays: list, dtype, shape: tuple = ()) -> np.ndarray:
+    return np.concatenate(arrays).astype(dtype) if arrays else np.empty((0,) + shape, dtype)
+
+
+def pack_graph(sc) -> dict:
+    """Returns the parsed chunks of an eagerly parsed SC file as flat arrays.
+
+    Geometry and timelines of all shapes and clips are concatenated into a
+    few arrays with offsets, and every chunk keeps the bytes it left
+    unread, so Graph can rebuild the chunks exactly. Strings and counts go
+    into a JSON header; nothing needs pickle to load.
+    """
+    chunks = sc.chunks
+    kinds = np.array([KIND_INDEX.get(type(chunk), RAW) for chunk in chunks], np.uint8)
+    by_kind = {kind: [chunk for chunk in chunks if type(chunk) is kind] for kind in KINDS}
+    tails = [bytes(chunk.buffer[chunk.i:]) for chunk in chunks]
+
+    textures = by_kind[Texture]
+    shapes = by_kind[Shape]
+    clips = by_kind[MovieClip]
+
+    region_tags = concatenate([shape.region_tags for shape in shapes], np.uint8)
+    texture_ids = concatenate([shape.texture_ids for shape in shapes], np.int8)
+    region_counts = concatenate([np.diff(shape.region_offsets) for shape in shapes], np.uint32)
+    sizes = np.array([(texture.width, texture.height) for texture in textures], np.float64).reshape(-1, 2)
+    sheet, uv = encode_points(
+        concatenate([shape.points for shape in shapes], REGION_POINT), region_tags, region_counts,
+        sizes[texture_ids] if len(texture_ids) else np.empty((0, 2))
+    )
+
+    header = {name: getattr(sc, name) for name in COUNT_ATTRIBUTES}
+    header.update({
+        'exports': [[export.id, export.name] for export in sc.exports],
+        'bind_names': [name for clip in clips for name in clip.bind_names],
+        'frame_names': [name for clip in clips for name in clip.frame_names],
+        'fonts': [text_field.font for text_field in by_kind[TextField]]
+    })
+
+    return {
+        'header': np.frombuffer(json.dumps(header).encode(), np.uint8),
+        'chunk_kinds': kinds,
+        'chunk_tags': np.array([chunk.tag for chunk in chunks], np.uint8),
+        'tail_offsets': offsets([len(tail) for tail in tails]),
+        'tails': np.frombuffer(b''.join(tails), np.uint8),
+
+        'texture_image_types': np.array([texture.image_type for texture in textures], np.int8),
+        'texture_sizes': sizes.astype(np.uint16),
+
+        'shape_ids': np.array([shape.id for shape in shapes], np.uint16),
+        'shape_counts': np.array(
+            [(shape.regions_count, shape.points_count) for shape in shapes], np.uint16
+        ).reshape(-1, 2),
+        'shape_region_offsets': offsets([len(shape.region_tags) for shape in shapes]),
+        'region_tags': region_tags,
+        'region_texture_ids': texture_ids,
+        'region_point_offsets': offsets(region_counts),
+        'point_sheets': sheet,
+        'point_uvs': uv,
+
+        'clip_ids': np.array([clip.id for clip in clips], np.uint16),
+        'clip_headers': np.array([(clip.clip_fps, clip.frames_count) for clip in clips], np.int32).reshape(-1, 2),
+        'clip_transform_offsets': offsets([len(clip.transforms) for clip in clips]),
+        'clip_transforms': concatenate([clip.transforms for clip in clips], np.uint16, (3,)),
+        'clip_bind_offsets': offsets([len(clip.bind_ids) for clip in clips]),
+        'clip_bind_ids': concatenate([clip.bind_ids for clip in clips], np.uint16),
+        'clip_bind_opacities': concatenate([
+            clip.bind_opacities if clip.bind_opacities is not None else np.zeros(len(clip.bind_ids), np.int8)
+            for clip in clips
+        ], np.int8),
+        'clip_frame_tag_offsets': offsets([len(clip.frame_tags) for clip in clips]),
+        'clip_frame_tags': concatenate([clip.frame_tags for clip in clips], np.uint8),
+        'clip_frame_lengths': concatenate([clip.frame_lengths for clip in clips], np.uint32),
+        'clip_frame_offsets': offsets([len(clip.frame_ids) for clip in clips]),
+        'clip_frame_ids': concatenate([clip.frame_ids for clip in clips], np.int16),
+
+        'text_field_ids': np.array([text_field.id for text_field in by_kind[TextField]], np.uint16),
+        'matrices': np.array([matrix.matrix for matrix in by_kind[Matrix]], np.float64).reshape(-1, 6),
+        'colors': np.array([color.color for color in by_kind[Color]], np.int32).reshape(-1, 4)
+    }
+
+
+class ColumnChunks(Mapping):
+    """Maps chunk ids to chunks that are only built from their columns when first looked up."""
+
+    def __init__(self, ids: np.ndarray, build):
+        self.positions = dict(zip(ids.tolist(), range(len(ids))))
+        self.build = build
+        self.chunks = {}
+
+    def at(self, position: int):
+        chunk = self.chunks.get(position)
+        if chunk is None:
+            chunk = self.chunks[position] = self.build(position)
+        return chunk
+
+    def __getitem__(self, chunk_id: int):
+        return self.at(self.positions[chunk_id])
+
+    def __contains__(self, chunk_id) -> bool:
+        return chunk_id in self.positions
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+
+class Graph:
+    """The chunks of an SC file, rebuilt from the arrays of pack_graph.
+
+    Textures, matrices and color transforms are built right away; shapes,
+    clips and text fields only when first looked up by id. The points of
+    all shapes are decoded at once, every shape is a view on them.
+    """
+
+    def __init__(self, arrays: dict):
+        self.arrays = arrays
+        self.header = json.loads(bytes(arrays['header']))
+
+        kinds = arrays['chunk_kinds']
+        self.chunk_indices = {kind: np.flatnonzero(kinds == index).tolist() for index, kind in enumerate(KINDS)}
+        self.tail_offsets = arrays['tail_offsets'].tolist()
+
+        self.exports = []
+        for export_id, name in self.header['exports']:
+            export = Export()
+            export.id = export_id
+            export.name = name
+            self.exports.append(export)
+
+        self.textures = [self.texture(i) for i in range(len(self.chunk_indices[Texture]))]
+        self.matrix = [self.matrix_chunk(i) for i in range(len(self.chunk_indices[Matrix]))]
+        self.color_transformations = [self.color(i) for i in range(len(self.chunk_indices[Color]))]
+
+        region_point_offsets = arrays['region_point_offsets']
+        texture_sizes = arrays['texture_sizes'].astype(np.float64)
+        texture_ids = arrays['region_texture_ids']
+        self.points = decode_points(
+            arrays['point_sheets'], arrays['point_uvs'], arrays['region_tags'], np.diff(region_point_offsets),
+            texture_sizes[texture_ids] if len(texture_ids) else np.empty((0, 2))
+        )
+
+        clip_bind_offsets = arrays['clip_bind_offsets'].tolist()
+        self.bind_names = [
+            self.header['bind_names'][clip_bind_offsets[i]:clip_bind_offsets[i + 1]]
+            for i in range(len(clip_bind_offsets) - 1)
+        ]
+
+        self.shapes = ColumnChunks(arrays['shape_ids'], self.shape)
+        self.clips = ColumnChunks(arrays['clip_ids'], self.clip)
+        self.text_fields = ColumnChunks(arrays['text_field_ids'], self.text_field)
+
+    def new(self, kind: type, position: int):
+        """Creates the position-th chunk of a kind over the bytes it left unread."""
+        chunk_index = self.chunk_indices[kind][position]
+        tail = self.arrays['tails'][self.tail_offsets[chunk_index]:self.tail_offsets[chunk_index + 1]]
+        return kind(tail, int(self.arrays['chunk_tags'][chunk_index]))
+
+    def texture(self, position: int) -> Texture:
+        texture = self.new(Texture, position)
+        texture.image_type = int(self.arrays['texture_image_types'][position])
+        texture.width, texture.height = self.arrays['texture_sizes'][position].tolist()
+        texture.size.width, texture.size.height = texture.width, texture.height
+        return texture
+
+    def matrix_chunk(self, position: int) -> Matrix:
+        matrix = self.new(Matrix, position)
+        matrix.matrix = self.arrays['matrices'][position].tolist()
+        return matrix
+
+    def color(self, position: int) -> Color:
+        color = self.new(Color, position)
+        color.color = self.arrays['colors'][position].tolist()
+        return color
+
+    def shape(self, position: int) -> Shape:
+        arrays = self.arrays
+        shape = self.new(Shape, position)
+        shape.id = int(arrays['shape_ids'][position])
+        shape.regions_count, shape.points_count = arrays['shape_counts'][position].tolist()
+
+        start, end = arrays['shape_region_offsets'][position:position + 2].tolist()
+        shape.region_tags = arrays['region_tags'][start:end]
+        shape.texture_ids = arrays['region_texture_ids'][start:end]
+
+        point_offsets = arrays['region_point_offsets'][start:end + 1]
+        shape.region_offsets = point_offsets - point_offsets[0]
+        shape.points = self.points[point_offsets[0]:point_offsets[-1]]
+        shape.build_regions()
+        return shape
+
+    def clip(self, position: int) -> MovieClip:
+        arrays = self.arrays
+        clip = self.new(MovieClip, position)
+        clip.id = int(arrays['clip_ids'][position])
+        clip.clip_fps, clip.frames_count = arrays['clip_headers'][position].tolist()
+
+        start, end = arrays['clip_transform_offsets'][position:position + 2].tolist()
+        clip.transforms = arrays['clip_transforms'][start:end]
+
+        start, end = arrays['clip_bind_offsets'][position:position + 2].tolist()
+        clip.bind_ids = arrays['clip_bind_ids'][start:end]
+        clip.bind_opacities = arrays['clip_bind_opacities'][start:end] if clip.tag == 12 else None
+        clip.bind_names = self.bind_names[position]
+
+        start, end = arrays['clip_frame_tag_offsets'][position:position + 2].tolist()
+        clip.frame_tags = arrays['clip_frame_tags'][start:end]
+        clip.frame_lengths = arrays['clip_frame_lengths'][start:end]
+
+        start, end = arrays['clip_frame_offsets'][position:position + 2].tolist()
+        clip.frame_ids = arrays['clip_frame_ids'][start:end]
+        clip.frame_names = self.header['frame_names'][start:end]
+
+        frame_offsets = np.zeros(len(clip.frame_ids) + 1, np.uint32)
+        np.cumsum(np.maximum(clip.frame_ids, 0), out=frame_offsets[1:])
+        clip.frame_offsets = frame_offsets
+        return clip
+
+    def text_field(self, position: int) -> TextField:
+        text_field = self.new(TextField, position)
+        text_field.id = int(self.arrays['text_field_ids'][position])
+        text_field.font = self.header['fonts'][position]
+        return text_field
+
+    def chunks(self) -> list:
+        """Returns every chunk in file order, building the ones not looked up yet."""
+        built = {
+            Texture: self.textures.__getitem__, Shape: self.shapes.at, MovieClip: self.clips.at,
+            TextField: self.text_fields.at, Matrix: self.matrix.__getitem__,
+            Color: self.color_transformations.__getitem__
+        }
+
+        chunks = []
+        positions = {kind: 0 for kind in KINDS}
+        tags = self.arrays['chunk_tags'].tolist()
+        for chunk_index, kind in enumerate(self.arrays['chunk_kinds'].tolist()):
+            if kind == RAW:
+                tail = self.arrays['tails'][self.tail_offsets[chunk_index]:self.tail_offsets[chunk_index + 1]]
+                chunks.append(ScObject(tail, tags[chunk_index]))
+                continue
+
+            kind = KINDS[kind]
+            chunks.append(built[kind](positions[kind]))
+            positions[kind] += 1
+        return chunks
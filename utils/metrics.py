@@ -0,0 +1,112 @@
+import json
+import time
+from contextlib import contextmanager
+
+from utils.files import write_atomic
+
+
+class Progress:
+    """Limits how often a progress line is redrawn.
+
+    due() is True at most once every interval seconds, and always for the
+    last item, so the final state is never skipped.
+    """
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.last = 0.0
+
+    def due(self, current: int, total: int) -> bool:
+        now = time.monotonic()
+        if current + 1 < total and now - self.last < self.interval:
+            return False
+
+        self.last = now
+        return True
+
+
+class Phase:
+    __slots__ = ('seconds', 'bytes', 'items', 'calls')
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.bytes = 0
+        self.items = 0
+        self.calls = 0
+
+    def add(self, bytes: int = 0, items: int = 1):
+        self.bytes += bytes
+        self.items += items
+
+    def to_dict(self) -> dict:
+        return {
+            'seconds': self.seconds,
+            'bytes': self.bytes,
+            'items': self.items,
+            'calls': self.calls
+        }
+
+
+class Metrics:
+    """Wall time, byte and item counts of every phase of unpacking one file.
+
+    Phases are timed with the phase() context manager; repeated phases
+    (one per texture, region, ...) add up. Chunks are counted per tag,
+    with the time spent parsing them.
+    """
+
+    def __init__(self, name: str = None):
+        self.name = name
+        self.phases = {}
+        self.tags = {}
+        self.unknown_tags = set()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = Phase()
+
+        start = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            phase.seconds += time.perf_counter() - start
+            phase.calls += 1
+
+    def tag(self, tag: int, known: bool = True) -> Phase:
+        phase = self.tags.get(tag)
+        if phase is None:
+            phase = self.tags[tag] = Phase()
+            if not known:
+                self.unknown_tags.add(tag)
+        return phase
+
+    def tag_time(self, tag: int, seconds: float):
+        """Adds the time spent parsing one chunk of a tag."""
+        phase = self.tag(tag)
+        phase.seconds += seconds
+        phase.calls += 1
+
+    def record(self, name: str, seconds: float, bytes: int = 0, items: int = 1):
+        """Adds a phase that was timed elsewhere, e.g. on another thread."""
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = Phase()
+
+        phase.seconds += seconds
+        phase.calls += 1
+        phase.add(bytes, items)
+
+    def report(self) -> dict:
+        return {
+            'file': self.name,
+            'seconds': time.perf_counter() - self.start,
+            'phases': {name: phase.to_dict() for name, phase in self.phases.items()},
+            'tags': {str(tag): phase.to_dict() for tag, phase in sorted(self.tags.items())},
+            'unknown_tags': sorted(self.unknown_tags)
+        }
+
+    def write(self, path: str):
+        write_atomic(path, json.dumps(self.report(), indent=4).encode())
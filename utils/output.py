@@ -0,0 +1,120 @@
+import json
+import math
+
+from PIL import Image
+
+
+IMAGE_FORMATS = {
+    'png': ['.png'],
+    'png-fast': ['.png'],
+    'webp': ['.webp'],
+    'raw': ['.rgba', '.json']
+}
+
+
+def save_image(image: Image.Image, path: str, image_format: str = 'png') -> list:
+    """Writes image to path plus the extensions of image_format and returns the written files.
+
+    png uses Pillow's default compression, png-fast the fastest zlib level,
+    webp is lossless, and raw writes the pixel bytes (.rgba) next to a JSON
+    header with the size and mode.
+    """
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f'Unsupported image format: {image_format}')
+
+    paths = [path + extension for extension in IMAGE_FORMATS[image_format]]
+    if image_format == 'png':
+        image.save(paths[0])
+    elif image_format == 'png-fast':
+        image.save(paths[0], compress_level=1)
+    elif image_format == 'webp':
+        image.save(paths[0], lossless=True, method=0)
+    elif image_format == 'raw':
+        with open(paths[0], 'wb') as fh:
+            fh.write(image.tobytes())
+        with open(paths[1], 'w') as fh:
+            json.dump({
+                'width': image.size[0],
+                'height': image.size[1],
+                'mode': image.mode
+            }, fh, indent=4)
+
+    return paths
+
+
+class SpriteSheet:
+    """Packs the sprites of an export into one image.
+
+    Sprites are placed on shelves, tallest first, in a sheet about as wide
+    as it is high. The same image added under several names is placed once.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.images = {}
+
+    def add(self, name: str, image: Image.Image):
+        self.names[name] = id(image)
+        self.images[id(image)] = image
+
+    def pack(self) -> tuple:
+        """Returns the sheet size and the (x, y) of every image id."""
+        images = sorted(self.images.items(), key=lambda item: (-item[1].size[1], -item[1].size[0]))
+
+        area = sum(image.size[0] * image.size[1] for _, image in images)
+        sheet_width = max([math.ceil(math.sqrt(area))] + [image.size[0] for _, image in images])
+
+        positions = {}
+        x = y = shelf_height = width = 0
+        for image_id, image in images:
+            if x + image.size[0] > sheet_width:
+                x = 0
+                y += shelf_height
+                shelf_height = 0
+
+            positions[image_id] = (x, y)
+            x += image.size[0]
+            width = max(width, x)
+            shelf_height = max(shelf_height, image.size[1])
+
+        return (max(width, 1), max(y + shelf_height, 1)), positions
+
+    def render(self) -> tuple:
+        """Returns the sheet image and its manifest: the rectangle of every sprite by name."""
+        size, positions = self.pack()
+
+        sheet = Image.new('RGBA', size, None)
+        for image_id, image in self.images.items():
+            sheet.paste(image, positions[image_id])
+
+        manifest = {}
+        for name, image_id in self.names.items():
+            x, y = positions[image_id]
+            width, height = self.images[image_id].size
+            manifest[name] = {'x': x, 'y': y, 'width': width, 'height': height}
+
+        return sheet, manifest
+
+
+ANIMATION_FORMATS = {
+    'apng': '.png',
+    'gif': '.gif'
+}
+
+
+def save_animation(images: list, path: str, fps: int, animation_format: str = 'apng') -> str:
+    """Writes frames as one looping animation to path plus the extension of animation_format.
+
+    Every frame covers the whole canvas, so it replaces the one before.
+    """
+    if animation_format not in ANIMATION_FORMATS:
+        raise ValueError(f'Unsupported animation format: {animation_format}')
+
+    path += ANIMATION_FORMATS[animation_format]
+    options = {'save_all': True, 'append_images': images[1:], 'duration': 1000 / fps, 'loop': 0}
+    if animation_format == 'apng':
+        images[0].save(path, 'PNG', default_image=False, disposal=0, blend=0, **options)
+    elif animation_format == 'gif':
+        images[0].save(path, 'GIF', disposal=2, **options)
+
+    return path
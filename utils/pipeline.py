@@ -0,0 +1,59 @@
+import asyncio
+from collections import namedtuple
+
+
+Stage = namedtuple('Stage', ['function', 'executor', 'workers'])
+
+DONE = object()
+
+
+async def run_pipeline(items, stages: list, callback, queue_size: int = 2):
+    """Passes every item through stages, running the stages of different items at the same time.
+
+    Each stage calls function(item, result of the previous stage) on its
+    executor with up to workers calls in flight. The stages are joined by
+    queues of queue_size items, so a fast stage waits for a slow one
+    instead of piling up results. An exception skips the remaining stages
+    of its item; callback(item, result or exception) is called as items
+    come out of the last stage.
+    """
+    loop = asyncio.get_running_loop()
+    queues = [asyncio.Queue(queue_size) for _ in range(len(stages) + 1)]
+
+    async def feed():
+        for item in items:
+            await queues[0].put((item, None))
+        await queues[0].put(DONE)
+
+    async def work(stage: Stage, source: asyncio.Queue, sink: asyncio.Queue):
+        while True:
+            entry = await source.get()
+            if entry is DONE:
+                # Left for the other workers of this stage
+                await source.put(DONE)
+                return
+
+            item, result = entry
+            if not isinstance(result, Exception):
+                try:
+                    result = await loop.run_in_executor(stage.executor, stage.function, item, result)
+                except Exception as exception:
+                    result = exception
+            await sink.put((item, result))
+
+    async def run_stage(stage: Stage, source: asyncio.Queue, sink: asyncio.Queue):
+        await asyncio.gather(*[work(stage, source, sink) for _ in range(stage.workers)])
+        await sink.put(DONE)
+
+    async def drain():
+        while True:
+            entry = await queues[-1].get()
+            if entry is DONE:
+                return
+            callback(*entry)
+
+    await asyncio.gather(
+        feed(),
+        *[run_stage(stage, queues[i], queues[i + 1]) for i, stage in enumerate(stages)],
+        drain()
+    )
@@ -0,0 +1,108 @@
+import numpy as np
+
+
+PIXEL_FORMATS = {
+    0: 'RGBA',
+    1: 'RGBA',
+    2: 'RGBA',
+    3: 'RGBA',
+    4: 'RGB',
+    6: 'LA',
+    10: 'L'
+}
+
+PIXEL_SIZES = {
+    0: 4,
+    2: 2,
+    4: 2,
+    6: 2,
+    10: 1
+}
+
+
+def get_pixel_format(pixel_type: int) -> str:
+    if pixel_type not in PIXEL_FORMATS:
+        raise TypeError('Ban.')
+    return PIXEL_FORMATS[pixel_type]
+
+
+def get_pixel_size(pixel_type: int) -> int:
+    if pixel_type not in PIXEL_SIZES:
+        raise TypeError(f'Unsupported pixel type: {pixel_type}')
+    return PIXEL_SIZES[pixel_type]
+
+
+def decode_pixels(buffer, pixel_type: int, width: int, height: int) -> np.ndarray:
+    """Decodes a raw pixel block into a (height, width, channels) uint8 array.
+
+    The channel layout matches the Pillow mode returned by get_pixel_format,
+    so the result can be handed to Image.frombuffer as is.
+    """
+    count = width * height
+
+    if pixel_type == 0:
+        pixels = np.frombuffer(buffer, np.uint8, count * 4)
+        return pixels.reshape(height, width, 4)
+    elif pixel_type == 2:
+        pixel = np.frombuffer(buffer, '<u2', count)
+        pixels = np.empty((count, 4), np.uint8)
+        pixels[:, 0] = ((pixel >> 12) & 0xF) << 4
+        pixels[:, 1] = ((pixel >> 8) & 0xF) << 4
+        pixels[:, 2] = ((pixel >> 4) & 0xF) << 4
+        pixels[:, 3] = (pixel & 0xF) << 4
+        return pixels.reshape(height, width, 4)
+    elif pixel_type == 4:
+        pixel = np.frombuffer(buffer, '<u2', count)
+        pixels = np.empty((count, 3), np.uint8)
+        pixels[:, 0] = ((pixel >> 11) & 0x1F) << 3
+        pixels[:, 1] = ((pixel >> 5) & 0x3F) << 2
+        pixels[:, 2] = (pixel & 0x1F) << 3
+        return pixels.reshape(height, width, 3)
+    elif pixel_type == 6:
+        pixel = np.frombuffer(buffer, '<u2', count)
+        pixels = np.empty((count, 2), np.uint8)
+        pixels[:, 0] = pixel >> 8
+        pixels[:, 1] = pixel & 0xFF
+        return pixels.reshape(height, width, 2)
+    elif pixel_type == 10:
+        pixels = np.frombuffer(buffer, np.uint8, count)
+        return pixels.reshape(height, width, 1)
+
+    raise TypeError(f'Unsupported pixel type: {pixel_type}')
+
+
+def join_pixels(pixels: np.ndarray, width: int, height: int, tile_size: int = 32) -> np.ndarray:
+    """Undoes the tiled pixel layout of file types 27 and 28.
+
+    Pixels are stored tile by tile: every row of full tiles is followed by
+    the partial tile on the right edge, and the partial row at the bottom
+    comes last. Returns a new (height, width, channels) array.
+    """
+    channels = pixels.shape[-1]
+    pixels = pixels.reshape(width * height, channels)
+    joined = np.empty((height, width, channels), np.uint8)
+
+    tiles_y, rest_y = divmod(height, tile_size)
+    tiles_x, rest_x = divmod(width, tile_size)
+    full_width = tiles_x * tile_size
+    full_height = tiles_y * tile_size
+
+    rows = pixels[:full_height * width].reshape(tiles_y, tile_size * width, channels)
+
+    tiles = rows[:, :full_width * tile_size].reshape(tiles_y, tiles_x, tile_size, tile_size, channels)
+    target = joined[:full_height, :full_width].reshape(tiles_y, tile_size, tiles_x, tile_size, channels)
+    target[...] = tiles.transpose(0, 2, 1, 3, 4)
+
+    right = rows[:, full_width * tile_size:]
+    joined[:full_height, full_width:] = right.reshape(full_height, rest_x, channels)
+
+    bottom = pixels[full_height * width:]
+
+    tiles = bottom[:full_width * rest_y].reshape(tiles_x, rest_y, tile_size, channels)
+    target = joined[full_height:, :full_width].reshape(rest_y, tiles_x, tile_size, channels)
+    target[...] = tiles.transpose(1, 0, 2, 3)
+
+    corner = bottom[full_width * rest_y:]
+    joined[full_height:, full_width:] = corner.reshape(rest_y, rest_x, channels)
+
+    return joined
@@ -1,91 +1,90 @@
+import struct
+
+import numpy as np
+
+
+STRUCTS = {
+    endian: {
+        fmt: struct.Struct(prefix + fmt)
+        for fmt in ('b', 'B', 'h', 'H', 'i', 'I', 'q', 'Q', 'f')
+    }
+    for endian, prefix in (('big', '>'), ('little', '<'))
+}
+
+INTEGER_FORMATS = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+
+
 class Reader:
     def __init__(self, buffer: bytes, endian: str = 'big'):
-        self.buffer = buffer
+        self.buffer = memoryview(buffer).cast('B')
         self.endian = endian
         self.i = 0
 
-    def read(self, length: int = 1):
+    def unpack(self, fmt: str):
+        unpacker = STRUCTS[self.endian][fmt]
+        result, = unpacker.unpack_from(self.buffer, self.i)
+        self.i += unpacker.size
+
+        return result
+
+    def read(self, length: int = 1) -> memoryview:
         result = self.buffer[self.i:self.i + length]
         self.i += length
 
         return result
 
-    def readUInteger(self, length: int = 1) -> int:
-        result = 0
-        for x in range(length):
-            byte = self.buffer[self.i]
-
-            bit_padding = x * 8
-            if self.endian == 'big':
-                bit_padding = (8 * (length - 1)) - bit_padding
+    def skip(self, length: int):
+        self.i += length
 
-            result |= byte << bit_padding
-            self.i += 1
+    def readArray(self, fmt: str, count: int) -> np.ndarray:
+        dtype = np.dtype(fmt).newbyteorder('<' if self.endian == 'little' else '>')
+        result = np.frombuffer(self.buffer, dtype, count, self.i)
+        self.i += dtype.itemsize * count
 
         return result
 
+    def readUInteger(self, length: int = 1) -> int:
+        if length in INTEGER_FORMATS:
+            return self.unpack(INTEGER_FORMATS[length].upper())
+        return int.from_bytes(self.read(length), self.endian, signed=False)
+
     def readInteger(self, length: int = 1) -> int:
-        integer = self.readUInteger(length)
-        result = integer
-        if integer > 2**(length * 8) / 2:
-            result -= 2**(length * 8)
-        return result
+        if length in INTEGER_FORMATS:
+            return self.unpack(INTEGER_FORMATS[length])
+        return int.from_bytes(self.read(length), self.endian, signed=True)
 
     def readUInt64(self) -> int:
-        return self.readUInteger(8)
+        return self.unpack('Q')
 
     def readInt64(self) -> int:
-        return self.readInteger(8)
+        return self.unpack('q')
 
     def readFloat(self) -> float:
-        asInt = self.readUInt32()
-        binary = bin(asInt)
-        binary = binary[2:].zfill(32)
-
-        sign = -1 if binary[0] == 1 else 1
-        exponent = int(binary[1:9], 2) - 127
-        mantissa_base = binary[9:]
-        mantissa_bin = '1' + mantissa_base
-        mantissa = 0
-        val = 1
-
-        if exponent == -127:
-            if mantissa_base[1] == -1:
-                return 0
-            else:
-                exponent = -126
-                mantissa_bin = '0' + mantissa_base
-
-        for char in mantissa_bin:
-            mantissa += val * int(char)
-            val = val / 2
-
-        result = sign * 2 ** exponent * mantissa
-        return result
+        return self.unpack('f')
 
     def readUInt32(self) -> int:
-        return self.readUInteger(4)
+        return self.unpack('I')
 
     def readInt32(self) -> int:
-        return self.readInteger(4)
+        return self.unpack('i')
 
     def readNUInt16(self) -> float:
         return self.readUInt16() / 65535
 
     def readUInt16(self) -> int:
-        return self.readUInteger(2)
+        return self.unpack('H')
 
     def readNInt16(self) -> float:
         return self.readInt16() / 32512
 
     def readInt16(self) -> int:
-        return self.readInteger(2)
+        return self.unpack('h')
 
     def readUInt8(self) -> int:
-        return self.readUInteger()
+        return self.unpack('B')
 
     def readInt8(self) -> int:
-        return self.readInteger()
+        return self.unpack('b')
 
     def readBool(self) -> bool:
         if self.readUInt8() >= 1:
@@ -93,6 +92,24 @@ class Reader:
         else:
             return False
 
+    def readUInt32Array(self, count: int) -> np.ndarray:
+        return self.readArray('u4', count)
+
+    def readInt32Array(self, count: int) -> np.ndarray:
+        return self.readArray('i4', count)
+
+    def readUInt16Array(self, count: int) -> np.ndarray:
+        return self.readArray('u2', count)
+
+    def readInt16Array(self, count: int) -> np.ndarray:
+        return self.readArray('i2', count)
+
+    def readUInt8Array(self, count: int) -> np.ndarray:
+        return self.readArray('u1', count)
+
+    def readInt8Array(self, count: int) -> np.ndarray:
+        return self.readArray('i1', count)
+
     readUInt = readUInteger
     readInt = readInteger
 
@@ -108,8 +125,14 @@ class Reader:
     readUByte = readUInt8
     readByte = readInt8
 
+    readUShortArray = readUInt16Array
+    readShortArray = readInt16Array
+
+    readUByteArray = readUInt8Array
+    readByteArray = readInt8Array
+
     def readChar(self, length: int = 1) -> str:
-        return self.read(length).decode('utf-8')
+        return str(self.read(length), 'utf-8')
 
     def readString(self) -> str:
         length = self.readUShort()
@@ -117,3 +140,6 @@ class Reader:
 
     def tell(self) -> int:
         return self.i
+
+    def remaining(self) -> int:
+        return len(self.buffer) - self.i
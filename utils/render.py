@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from utils.metrics import Metrics
+from utils.output import IMAGE_FORMATS, save_image
+
+
+class ColorTransforms:
+    """Combined multiply/add transforms of nested color ids, each worked out once."""
+
+    def __init__(self, colors: list):
+        self.colors = colors
+        self.transforms = {}
+
+    def get(self, color_ids: tuple):
+        """Returns (multiply, add) of color ids listed outermost first, or None when they change nothing."""
+        if color_ids in self.transforms:
+            return self.transforms[color_ids]
+
+        multiply = np.ones(4, np.float32)
+        add = np.zeros(4, np.float32)
+        for color_id in reversed(color_ids):
+            if color_id < len(self.colors):
+                color_multiply, color_add = self.colors[color_id].transform()
+                multiply = multiply * color_multiply
+                add = add * color_multiply + color_add
+
+        transform = None
+        if (multiply != 1).any() or add.any():
+            transform = multiply, add
+        self.transforms[color_ids] = transform
+        return transform
+
+
+def apply_color(image: Image.Image, multiply: np.ndarray, add: np.ndarray) -> Image.Image:
+    """Multiplies and adds RGBA image pixels channel by channel."""
+    pixels = np.asarray(image.convert('RGBA'), np.float32) * multiply + add
+    return Image.fromarray(np.clip(pixels + 0.5, 0, 255).astype(np.uint8), 'RGBA')
+
+
+class RegionCache:
+    """Least recently used cache of rendered regions, bounded by pixel memory.
+
+    Regions are keyed by texture id, polygon and the color transforms
+    applied, so a shape bound by many clips is only cut from its texture
+    (and tinted) once.
+    """
+
+    def __init__(self, max_size: int = 256 << 20):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.images = OrderedDict()
+
+    @staticmethod
+    def key(texture_id: int, polygon: list, color_ids: tuple = ()) -> tuple:
+        return texture_id, tuple(polygon), color_ids
+
+    @staticmethod
+    def image_size(image: Image.Image) -> int:
+        return image.size[0] * image.size[1] * len(image.getbands())
+
+    def get(self, key: tuple):
+        image = self.images.get(key)
+        if image is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.images.move_to_end(key)
+        return image
+
+    def put(self, key: tuple, image: Image.Image):
+        size = self.image_size(image)
+        if size > self.max_size:
+            return
+
+        self.images[key] = image
+        self.size += size
+        while self.size > self.max_size:
+            _, evicted = self.images.popitem(last=False)
+            self.size -= self.image_size(evicted)
+
+
+class SpriteWriter:
+    """Encodes sprites on a pool of threads, every distinct image only once.
+
+    Paths are given without extension, image_format decides which files are
+    written (see utils.output). At most max_pending images wait for an
+    encoder, so memory stays flat however large an export is. An image
+    whose pixels were already written is hard linked to the first files
+    once the encoders are done. When the file system can not link, the
+    duplicate is recorded in manifest.json of its folder instead.
+    """
+
+    manifest_filename = 'manifest.json'
+
+    def __init__(self, workers: int = 4, max_pending: int = None, metrics: Metrics = None,
+                 image_format: str = 'png'):
+        self.executor = ThreadPoolExecutor(workers)
+        self.image_format = image_format
+        self.extensions = IMAGE_FORMATS[image_format]
+        self.max_pending = max_pending or workers * 2
+        self.pending = deque()
+        self.metrics = metrics
+
+        self.paths = {}
+        self.duplicates = []
+        self.manifests = {}
+        self.written = 0
+        self.linked = 0
+
+    @staticmethod
+    def digest(image: Image.Image) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f'{image.mode}:{image.size[0]}x{image.size[1]}'.encode())
+        digest.update(image.tobytes())
+        return digest.digest()
+
+    def encode(self, image: Image.Image, path: str) -> tuple:
+        start = time.perf_counter()
+        paths = save_image(image, path, self.image_format)
+        return time.perf_counter() - start, sum(os.path.getsize(path) for path in paths)
+
+    def wait(self):
+        seconds, size = self.pending.popleft().result()
+        if self.metrics is not None:
+            self.metrics.record('png_encode', seconds, size)
+
+    def save(self, image: Image.Image, path: str):
+        # A file left over from an earlier run may be linked to others, so it is never written in place.
+        for extension in self.extensions:
+            if os.path.lexists(path + extension):
+                os.remove(path + extension)
+
+        digest = self.digest(image)
+        original = self.paths.get(digest)
+        if original is not None:
+            self.duplicates.append((original, path))
+            self.linked += 1
+            return
+
+        while len(self.pending) >= self.max_pending:
+            self.wait()
+
+        self.pending.append(self.executor.submit(self.encode, image, path))
+        self.paths[digest] = path
+        self.written += 1
+
+    def link(self, original: str, path: str):
+        for extension in self.extensions:
+            try:
+                os.link(original + extension, path + extension)
+            except OSError:
+                folder, filename = os.path.split(path + extension)
+                manifest = self.manifests.setdefault(folder, {})
+                manifest[filename] = os.path.relpath(original + extension, folder).replace(os.sep, '/')
+
+    def close(self):
+        while self.pending:
+            self.wait()
+        self.executor.shutdown()
+
+        for original, path in self.duplicates:
+            self.link(original, path)
+        self.duplicates = []
+
+        for folder, manifest in self.manifests.items():
+            with open(os.path.join(folder, self.manifest_filename), 'w') as fh:
+                json.dump(manifest, fh, indent=4)
+        self.manifests = {}
@@ -0,0 +1,85 @@
+import io
+import lzma
+import mmap
+
+from sc_compression.compression import Decompressor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+CHUNK_SIZE = 1 << 16
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def map_file(path: str) -> mmap.mmap:
+    with open(path, 'rb') as fh:
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class LzmaStream(io.RawIOBase):
+    """Decompresses an SC flavoured LZMA payload on demand.
+
+    SC files store a 4-byte uncompressed size where the LZMA "alone" format
+    expects 8 bytes, so the header is rebuilt before the first chunk is fed.
+    """
+
+    def __init__(self, payload: memoryview, chunk_size: int = CHUNK_SIZE):
+        super().__init__()
+        self.payload = payload
+        self.chunk_size = chunk_size
+        self.offset = 9
+        self.pending = bytes(payload[:5]) + b'\xff' * 8
+        self.decompressor = lzma.LZMADecompressor(lzma.FORMAT_ALONE)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.decompressor.eof:
+            data = b''
+            if self.decompressor.needs_input:
+                if self.pending:
+                    data, self.pending = self.pending, b''
+                elif self.offset < len(self.payload):
+                    data = self.payload[self.offset:self.offset + self.chunk_size]
+                    self.offset += len(data)
+                else:
+                    break
+
+            chunk = self.decompressor.decompress(data, len(buffer))
+            if chunk:
+                buffer[:len(chunk)] = chunk
+                return len(chunk)
+        return 0
+
+
+def open_stream(path: str):
+    """Memory-maps a compressed .sc file and returns (stream, size).
+
+    The stream yields the decompressed payload incrementally, so only the
+    part the parser is currently looking at has to be resident. Formats
+    that cannot be streamed are decompressed in one go as a fallback.
+    """
+    mapped = map_file(path)
+    payload = memoryview(mapped)
+
+    if payload[:4] == b'Sig:':
+        payload = payload[68:]
+    elif payload[:2] == b'SC' and payload[26:30] != b'SCLZ':
+        payload = payload[26:]
+
+    if payload[1:5] == b'\x00\x00\x04\x00':
+        size = int.from_bytes(payload[5:9], 'little')
+        return io.BufferedReader(LzmaStream(payload), CHUNK_SIZE), size
+    elif payload[:4] == ZSTD_MAGIC and zstandard is not None:
+        size = zstandard.frame_content_size(payload)
+        if size >= 0:
+            reader = zstandard.ZstdDecompressor().stream_reader(payload)
+            return io.BufferedReader(reader, CHUNK_SIZE), size
+
+    buffer = Decompressor().decompress(bytes(mapped))
+    return io.BytesIO(buffer), len(buffer)
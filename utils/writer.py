@@ -1,90 +1,62 @@
+from utils.reader import STRUCTS, INTEGER_FORMATS
+
+
 class Writer:
     def __init__(self, endian: str = 'big'):
         super(Writer, self).__init__()
         self.endian = endian
-        self.buffer = b''
+        self.buffer = bytearray()
+
+    def pack(self, fmt: str, value):
+        self.buffer += STRUCTS[self.endian][fmt].pack(value)
 
     def write(self, data: bytes):
         self.buffer += data
 
     def writeUInteger(self, integer: int, length: int = 1):
-        self.buffer += integer.to_bytes(length, self.endian, signed=False)
+        if length in INTEGER_FORMATS:
+            self.pack(INTEGER_FORMATS[length].upper(), integer)
+        else:
+            self.buffer += integer.to_bytes(length, self.endian, signed=False)
 
     def writeInteger(self, integer: int, length: int = 1):
-        self.buffer += integer.to_bytes(length, self.endian, signed=True)
+        if length in INTEGER_FORMATS:
+            self.pack(INTEGER_FORMATS[length], integer)
+        else:
+            self.buffer += integer.to_bytes(length, self.endian, signed=True)
 
     def writeUInt64(self, integer: int):
-        self.writeUInteger(integer, 8)
+        self.pack('Q', integer)
 
     def writeInt64(self, integer: int):
-        self.writeInteger(integer, 8)
+        self.pack('q', integer)
 
     def writeFloat(self, floating: float):
-        exponent = 0
-        sign = 1
-
-        if floating < 0:
-            sign = -1
-            floating = -floating
-
-        if floating >= 2 ** -1022:
-            value = floating
-
-            while value < 1:
-                exponent -= 1
-                value *= 2
-            while value >= 2:
-                exponent += 1
-                value /= 2
-
-        mantissa = floating / 2 ** exponent
-
-        exponent += 127
-
-        as_integer_bin = '0'
-        if sign == -1:
-            as_integer_bin = '1'
-
-        as_integer_bin += bin(exponent)[2:].zfill(8)
-
-        mantissa_bin = ''
-        for x in range(24):
-            bit = '0'
-            if mantissa >= 1/2**x:
-                mantissa -= 1/2**x
-                bit = '1'
-            mantissa_bin += bit
-
-        mantissa_bin = mantissa_bin[1:]
-
-        as_integer_bin += mantissa_bin
-        as_integer = int(as_integer_bin, 2)
-
-        self.writeUInt32(as_integer)
+        self.pack('f', floating)
 
     def writeUInt32(self, integer: int):
-        self.writeUInteger(integer, 4)
+        self.pack('I', integer)
 
     def writeInt32(self, integer: int):
-        self.writeInteger(integer, 4)
+        self.pack('i', integer)
 
-    def writeNUInt16(self, integer: int):
-        self.writeUInt16(integer * 65535)
+    def writeNUInt16(self, integer: float):
+        self.writeUInt16(round(integer * 65535))
 
     def writeUInt16(self, integer: int):
-        self.writeUInteger(integer, 2)
+        self.pack('H', integer)
 
-    def writeNInt16(self, integer: int):
-        self.writeInt16(integer * 32512)
+    def writeNInt16(self, integer: float):
+        self.writeInt16(round(integer * 32512))
 
     def writeInt16(self, integer: int):
-        self.writeInteger(integer, 2)
+        self.pack('h', integer)
 
     def writeUInt8(self, integer: int):
-        self.writeUInteger(integer)
+        self.pack('B', integer)
 
     def writeInt8(self, integer: int):
-        self.writeInteger(integer)
+        self.pack('b', integer)
 
     def writeBool(self, boolean: bool):
         if boolean:
@@ -108,8 +80,7 @@ class Writer:
     writeByte = writeInt8
 
     def writeChar(self, string: str):
-        for char in list(string):
-            self.buffer += char.encode('utf-8')
+        self.buffer += string.encode('utf-8')
 
     def writeString(self, string: str):
         encoded = string.encode('utf-8')